@@ -46,7 +46,10 @@
 
 import calendar
 import sys
+import os
 import time
+import json
+import contextlib
 import optparse
 import lib.xcairo as xcairo
 import lib.holiday as holiday
@@ -175,6 +178,9 @@ def get_parser():
                       help="user the short version of month names (defined in language file) [%default]")
     parser.add_option("--long-daynames", action="store_true", default=False,
                     help="user the long version of day names (defined in language file) [%default]")
+    parser.add_option("--compile-holidays", action="store_true", default=False,
+                    help="compile the holiday files given with -H into a binary form (FILEc) that loads "
+                    "faster, then exit; stale compiled files are ignored")
     parser.add_option("-T", "--terse-holidays", action="store_false", dest="multiday_holidays",
                     default=True, help="do not print holiday end markers and omit dots")
 
@@ -187,14 +193,171 @@ def get_parser():
                     help="modify a style variable, e.g. dom.frame_thickness=0")
     parser.add_option("--geom-var", action="append", dest="geom_assign",
                     help="modify a geometry variable")
+    parser.add_option("--serve", action="store_true", default=False,
+                    help="batch mode: read render requests as JSON lines from standard input and "
+                    "write one JSON status line per request to standard output, keeping plugins, "
+                    "holidays and font caches loaded; a request is an object with keys outfile "
+                    "(required), year, month (MONTH[-MONTH2|:SPAN]), lang, layout, style, geometry, "
+                    "paper, dpi, border, holidays (list of files), args (list of extra options) and id")
     return parser
 
 
-def main_program():
+_plugins = dict()
+"""plugins loaded by L{load_plugin}, indexed by I{(cat,preset)}"""
+
+_plugin_states = dict()
+"""snapshots of all plugin modules imported so far (including modules imported by plugins, e.g.
+C{style.default} by C{style.gfs}), indexed by module name; values are I{(module,state)} tuples,
+see L{_plugin_state}"""
+
+_plugin_cats = ("lang", "style", "geom", "layouts")
+"""plugin categories, i.e. packages holding plugin modules"""
+
+def _plugin_state(m):
+    """take a snapshot of the attributes of plugin module I{m} and of the plugin classes it contains
+
+    @rtype: dict
+    @return: dict of I{(value,class_attributes)} tuples indexed by attribute name, where
+    I{class_attributes} is C{None} unless I{value} is a class of the same plugin category
+    """
+    state = dict()
+    pkg = m.__name__.split('.')[0]
+    for name, value in vars(m).items():
+        if isinstance(value, type) and value.__module__.split('.')[0] == pkg:
+            state[name] = (value, dict((k, v) for k, v in vars(value).items() if not k.startswith('__')))
+        else:
+            state[name] = (value, None)
+    return state
+
+def _restore_plugin(m, state):
+    """restore plugin module I{m} in place to a snapshot taken by L{_plugin_state}
+
+    Classes are restored in place (not replaced), since other objects may refer to them.
+    """
+    for name in [x for x in vars(m) if x not in state and not x.startswith('__')]:
+        delattr(m, name)
+    for name, (value, attrs) in state.items():
+        setattr(m, name, value)
+        if attrs is None: continue
+        for k in [x for x in vars(value) if x not in attrs and not x.startswith('__')]:
+            delattr(value, k)
+        for k, v in attrs.items():
+            setattr(value, k, v)
+
+def restore_plugins():
+    """restore all plugin modules imported so far to the state they had right after importing
+
+    Rendering modifies plugin variables (e.g. with C{--style-var}), possibly of modules other
+    than the requested plugins (e.g. C{style.default}, whose classes are inherited by other
+    styles), hence all modules are restored, not just those about to be reused.
+    """
+    for m, state in _plugin_states.values():
+        _restore_plugin(m, state)
+
+def load_plugin(plugin_paths, cat, longcat, longcat2, listopt, preset):
+    """import a plugin using L{import_plugin}, or reuse a plugin imported before
+
+    Newly imported plugin modules (the plugin itself and any plugin module it imports) are
+    snapshotted, so that they can be restored by L{restore_plugins}.
+
+    @rtype: module
+    """
+    key = (cat, preset)
+    if key in _plugins: return _plugins[key]
+    m = import_plugin(plugin_paths, cat, longcat, longcat2, listopt, preset)
+    _plugins[key] = m
+    for name, mod in list(sys.modules.items()):
+        if mod is not None and name not in _plugin_states and name.split('.')[0] in _plugin_cats and '.' in name:
+            _plugin_states[name] = (mod, _plugin_state(mod))
+    return m
+
+_hproviders = dict()
+"""holiday providers built by L{get_holiday_provider}, indexed by style, holiday files and options"""
+
+def get_holiday_provider(Style, style_name, holiday_files, multiday_holidays):
+    """return a L{holiday.HolidayProvider} for I{Style} loaded with I{holiday_files}, reusing a previous one if possible
+
+    A provider is reused only if none of its holiday files has been modified since loading.
+
+    @rtype: holiday.HolidayProvider
+    """
+    holiday_files = holiday_files or []
+    try:
+        key = (style_name, tuple((f, os.path.getmtime(f)) for f in holiday_files), multiday_holidays)
+    except OSError:
+        key = None # let load_holiday_file() report the error
+    if key in _hproviders: return _hproviders[key]
+    hprovider = holiday.HolidayProvider(Style.dom, Style.dom_weekend,
+                                 Style.dom_holiday, Style.dom_weekend_holiday,
+                                 Style.dom_multi, Style.dom_weekend_multi, multiday_holidays)
+    for f in holiday_files:
+        hprovider.load_holiday_file(f)
+    if key is not None: _hproviders[key] = hprovider
+    return hprovider
+
+def _request_argv(req):
+    """build a callirhoe argument list from a L{serve} request
+
+    @param req: dict with optional keys I{lang, layout, style, geometry, paper, dpi, border},
+    I{holidays} (list of files), I{args} (list of extra arguments), I{month} (MONTH[-MONTH2|:SPAN]),
+    I{year} and mandatory key I{outfile}
+    @rtype: [str,...]
+    """
+    argv = ['callirhoe']
+    for key in ['lang', 'layout', 'style', 'geometry', 'paper', 'dpi', 'border']:
+        if key in req: argv.append('--%s=%s' % ('geom' if key == 'geometry' else key, req[key]))
+    for f in req.get('holidays', []):
+        argv += ['-H', f]
+    argv += req.get('args', [])
+    if 'month' in req: argv.append(str(req['month']))
+    if 'month' in req or 'year' in req: argv.append(str(req.get('year', 0)))
+    if 'outfile' not in req: raise lib.Abort("callirhoe: request without outfile")
+    argv.append(req['outfile'])
+    return argv
+
+def serve(fin, fout):
+    """batch mode: render calendars requested as JSON lines from I{fin}, answering on I{fout}
+
+    Each request is a JSON object as described in L{_request_argv}, with an optional I{id}
+    that is copied to the answer. Each answer is a JSON line with I{status} either C{"ok"}
+    or C{"error"} (along with an I{error} message). Plugins, holiday providers and font
+    caches stay loaded between requests.
+    """
+    for line in fin:
+        line = line.strip()
+        if not line: continue
+        res = dict()
+        try:
+            req = json.loads(line)
+            if 'id' in req: res['id'] = req['id']
+            argv = _request_argv(req)
+            with contextlib.redirect_stdout(sys.stderr):
+                main_program(argv)
+            res.update(status = "ok", outfile = argv[-1])
+        except lib.Abort as e:
+            res.update(status = "error", error = str(e.args[0]))
+        except SystemExit as e:
+            res.update(status = "error", error = "exit status %s" % e.code)
+        except Exception as e:
+            res.update(status = "error", error = "%s: %s" % (type(e).__name__, e))
+        fout.write(json.dumps(res) + '\n')
+        fout.flush()
+
+def main_program(argv = None, page_sink = None):
+    """this is the main program routine
+
+    @param argv: argument list, defaults to C{sys.argv}
+    @param page_sink: if not C{None}, list receiving the rendered PNG pages as C{bytes},
+    instead of writing them to the output file (whose name must still end in C{.png})
+    """
     parser = get_parser()
 
-    sys.argv,argv2 = lib.extract_parser_args(sys.argv,parser)
-    (options,args) = parser.parse_args()
+    argv1,argv2 = lib.extract_parser_args(sys.argv if argv is None else argv,parser)
+    (options,args) = parser.parse_args(argv1[1:])
+
+    if options.serve:
+        if argv is None: serve(sys.stdin, sys.stdout)
+        return
 
     list_and_exit = False
     if options.list_languages:
@@ -215,11 +378,22 @@ def main_program():
         list_and_exit = True
     if list_and_exit: return
 
+    if options.compile_holidays:
+        if not options.holidays:
+            raise lib.Abort("callirhoe: --compile-holidays requires at least one holiday file (-H)")
+        for f in options.holidays:
+            try:
+                holiday.compile_holiday_file(f)
+            except (IOError, ValueError) as e:
+                raise lib.Abort("callirhoe: cannot compile holiday file '%s': %s" % (f, e))
+        return
+
     plugin_paths = get_plugin_paths()
-    Language = import_plugin(plugin_paths, "lang", "language", "languages", "--list-languages", options.lang)
-    Style = import_plugin(plugin_paths, "style", "style", "styles", "--list-styles", options.style)
-    Geometry = import_plugin(plugin_paths, "geom", "geometry", "geometries", "--list-geometries", options.geom)
-    Layout = import_plugin(plugin_paths, "layouts", "layout", "layouts", "--list-layouts", options.layout)
+    restore_plugins()
+    Language = load_plugin(plugin_paths, "lang", "language", "languages", "--list-languages", options.lang)
+    Style = load_plugin(plugin_paths, "style", "style", "styles", "--list-styles", options.style)
+    Geometry = load_plugin(plugin_paths, "geom", "geometry", "geometries", "--list-geometries", options.geom)
+    Layout = load_plugin(plugin_paths, "layouts", "layout", "layouts", "--list-layouts", options.layout)
 
     for x in argv2:
         if '=' in x: x = x[0:x.find('=')]
@@ -280,13 +454,7 @@ def main_program():
     Geometry.pagespec = options.paper
     Geometry.border = options.border
 
-    hprovider = holiday.HolidayProvider(Style.dom, Style.dom_weekend,
-                                 Style.dom_holiday, Style.dom_weekend_holiday,
-                                 Style.dom_multi, Style.dom_weekend_multi, options.multiday_holidays)
-
-    if options.holidays:
-        for f in options.holidays:
-            hprovider.load_holiday_file(f)
+    hprovider = get_holiday_provider(Style, options.style, options.holidays, options.multiday_holidays)
 
     if options.long_daynames:
         Language.day_name = Language.long_day_name
@@ -300,6 +468,7 @@ def main_program():
 
     renderer = Layout.CalendarRenderer(Outfile, Year, Month, MonthSpan,
                                         (Style,Geometry,Language), hprovider, lib._version, loptions)
+    renderer.page_sink = page_sink
     renderer.render()
 
 
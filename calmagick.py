@@ -29,13 +29,36 @@ import os.path
 import os
 import tempfile
 import glob
+import fnmatch
+import itertools
+import array
+import heapq
+import time
+import hashlib
+import socket
+import json
+import sqlite3
 import random
 import optparse
 import queue
 import threading
+import contextlib
+import io
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import cairo
+except ImportError:
+    cairo = None
 
 import lib
 from lib.geom import rect_rel_scale
+from math import sqrt
 
 # MAYBE-TODO
 # move to python 3?
@@ -59,6 +82,50 @@ def run_callirhoe(style, size, args, outfile):
     """
     return subprocess.Popen(['callirhoe', '-s', style, '--paper=-%d:-%d' % size] + args + [outfile])
 
+_callirhoe = None
+"""callirhoe module used for in-process rendering, C{False} if it cannot be imported, C{None} if not yet imported"""
+_render_mutex = threading.Lock()
+"""mutex for in-process rendering, since callirhoe keeps rendering state in its plugin modules"""
+
+def _import_callirhoe():
+    """import the callirhoe module for in-process rendering
+
+    @rtype: module
+    @return: callirhoe module, or C{None} if it cannot be imported (e.g. pycairo is missing)
+    """
+    global _callirhoe
+    with _render_mutex:
+        if _callirhoe is None:
+            try:
+                import callirhoe
+                _callirhoe = callirhoe
+            except ImportError:
+                _callirhoe = False
+    return _callirhoe or None
+
+def render_callirhoe(style, size, args):
+    """generate a calendar in-process, without launching callirhoe
+
+    @param style: calendar style to use (passes -s option to callirhoe)
+    @param size: tuple (I{width},I{height}) for output calendar size (in pixels)
+    @param args: (extra) argument list to pass to callirhoe
+    @rtype: bytes
+    @return: calendar image in PNG format
+    @raise lib.Abort: if callirhoe rejects its arguments (e.g. unknown style or option), since
+    this would fail for every photo
+    """
+    sink = []
+    with _render_mutex:
+        try:
+            _callirhoe.main_program(['callirhoe', '-s', style, '--paper=-%d:-%d' % size] + args +
+                                    ['calmagick.png'], page_sink = sink)
+        except SystemExit as e:
+            # raised by the option parser, or when a style/layout/language/geometry is not found
+            raise lib.Abort(e.code if isinstance(e.code, str) else
+                            "calmagick: invalid callirhoe arguments: %s" % ' '.join(args))
+    if len(sink) != 1: raise RuntimeError("calmagick: calendar creation failed")
+    return sink[0]
+
 def _bound(x, lower, upper):
     """return the closest number to M{x} that lies in [M{lower,upper}]
 
@@ -68,70 +135,121 @@ def _bound(x, lower, upper):
     if x > upper: return upper
     return x
 
-class PNMImage(object):
-    """class to represent an PNM grayscale image given in P2 format
+def _pnm_header(buf):
+    """parse the header of a PNM image
 
-    @ivar data: image data as 2-dimensional array (list of lists)
-    @ivar size: tuple M{(width,height)} of image dimensions
-    @ivar maxval: maximum grayscale value
-    @ivar _rsum_cache: used by L{_rsum()} to remember results
-    @ivar xsum: 2-dimensional array of running x-sums for each line, used for efficient
-    computation of block averages, resulting in M{O(H)} complexity, instead of M{O(W*H)},
-    where M{W,H} the image dimensions
-    """
-    def __init__(self, strlist):
-        self.data = [];
-        state = 0;
-        for i in range(len(strlist)):
-            # skip comments
-            if strlist[i].startswith(b'#'): continue
-            # skip empty lines
-            if len(strlist[i]) == 0: continue
-            # parse header
-            if state == 0:
-                if not strlist[i].startswith(b'P2'):
-                    raise RuntimeError('invalid PNM image format: %s' % strlist[i])
-                state += 1
-            # parse size
-            elif state == 1:
-                w,h = list(map(int,strlist[i].split()))
-                if w != h:
-                    raise RuntimeError('non-square PNM image')
-                self.size = (w,h)
-                state += 1
-            # parse max value
-            elif state == 2:
-                self.maxval = int(strlist[i])
-                state += 1
-            # bitmap
+    @param buf: image data
+    @rtype: (bytes,int,int,int,int)
+    @return: tuple (I{magic,width,height,maxval,offset}), where I{offset} is the position of the
+    first byte of the raster
+    """
+    fields = []
+    pos = 0
+    n = len(buf)
+    while len(fields) < 4:
+        # skip whitespace and comments
+        while pos < n and buf[pos:pos+1] in b' \t\r\n#':
+            if buf[pos:pos+1] == b'#':
+                while pos < n and buf[pos:pos+1] not in b'\r\n': pos += 1
             else:
-                data = ' '.join([s.decode('utf-8') for s in strlist[i:] if not s.startswith(b'#')])
-                intlist = list(map(int,data.split()))
-                self.data = [intlist[x:x+w] for x in range(0, len(intlist), w)]
-                break
+                pos += 1
+        start = pos
+        while pos < n and buf[pos:pos+1] not in b' \t\r\n#': pos += 1
+        if start == pos:
+            raise RuntimeError('truncated PNM image')
+        fields.append(bytes(buf[start:pos]))
+    magic = fields[0]
+    if magic not in (b'P2', b'P5'):
+        raise RuntimeError('invalid PNM image format: %s' % magic)
+    w,h,maxval = list(map(int,fields[1:]))
+    # a single whitespace character separates the header from the raster
+    return magic, w, h, maxval, pos+1
+
+def _pnm_frames(buf):
+    """split a stream of concatenated binary PNM images (as written by ImageMagick for multiple images)
+
+    @param buf: stream data
+    @rtype: [memoryview,...]
+    """
+    buf = memoryview(buf)
+    frames = []
+    while len(buf) > 0:
+        magic, w, h, maxval, pos = _pnm_header(buf)
+        if magic != b'P5':
+            raise RuntimeError('invalid PNM image format in stream: %s' % magic)
+        end = pos + w*h*(2 if maxval > 255 else 1)
+        frames.append(buf[0:end])
+        buf = buf[end:]
+        # skip trailing whitespace
+        while len(buf) > 0 and buf[0:1] in b' \t\r\n': buf = buf[1:]
+    return frames
 
-        self._rsum_cache=(-1,-1,0) # y,x,s
-#        self.xsum = [map(lambda x: sum(self.data[y][0:x]), range(w+1)) for y in range(0,h)]
-        self.xsum = [[self._rsum(y,x) for x in range(w+1)] for y in range(0,h)]
+class PNMImage(object):
+    """class to represent an PNM grayscale image given in P2 (plain) or P5 (binary, 8 or 16 bit) format
 
-    def _rsum(self,y,x):
-        """running sum with cache
+    @ivar data: image data as 2-dimensional array (NumPy array if NumPy is available, otherwise
+    list of rows)
+    @ivar size: tuple M{(width,height)} of image dimensions
+    @ivar maxval: maximum grayscale value
+    @ivar isum: integral image (summed-area table) of size M{(H+1)*(W+1)}, where M{isum[y][x]} is the
+    sum of all pixels above and to the left of M{(x,y)}, used for computing block averages in
+    M{O(1)} time, instead of M{O(W*H)}, where M{W,H} the image dimensions; a NumPy array if
+    NumPy is available, otherwise a list of lists
+    """
+    def __init__(self, buf):
+        """parse a PNM image
 
-        @rtype: int
+        @param buf: image data as a bytes-like object, or as a list of lines (for P2 format)
         """
-        if self._rsum_cache[0] == y and self._rsum_cache[1] == x:
-            s = self._rsum_cache[2] + self.data[y][x-1]
+        if isinstance(buf, list): buf = b'\n'.join(buf)
+        buf = memoryview(buf)
+        magic, w, h, self.maxval, pos = _pnm_header(buf)
+        self.size = (w,h)
+        if magic == b'P2':
+            intlist = list(map(int,b' '.join([s for s in bytes(buf[pos:]).splitlines() if not s.startswith(b'#')]).split()))
+            if len(intlist) < w*h:
+                raise RuntimeError('truncated PNM image')
+            pixels = intlist[0:w*h]
+            self.data = numpy.array(pixels).reshape(h,w) if numpy is not None else [pixels[x:x+w] for x in range(0, w*h, w)]
         else:
-            s = sum(self.data[y][0:x])
-        self._rsum_cache = (y,x+1,s)
-        return s
+            wide = self.maxval > 255
+            if len(buf) - pos < w*h*(2 if wide else 1):
+                raise RuntimeError('truncated PNM image')
+            if numpy is not None:
+                self.data = numpy.frombuffer(buf, dtype='>u2' if wide else 'u1', count=w*h, offset=pos).reshape(h,w)
+            else:
+                pixels = array.array('H' if wide else 'B')
+                pixels.frombytes(buf[pos:pos+w*h*pixels.itemsize])
+                if wide and sys.byteorder == 'little': pixels.byteswap()
+                self.data = [pixels[x:x+w] for x in range(0, w*h, w)]
+
+        self.isum = self._integral_image()
+
+    def _integral_image(self):
+        """compute the summed-area table of the image, see L{isum}"""
+        w,h = self.size
+        if numpy is not None:
+            isum = numpy.zeros((h+1,w+1), dtype=numpy.int64)
+            isum[1:,1:] = numpy.asarray(self.data, dtype=numpy.int64).cumsum(0).cumsum(1)
+            return isum
+        isum = [[0]*(w+1)]
+        for y in range(h):
+            above = isum[-1]
+            row = [0]*(w+1)
+            s = 0
+            for x in range(w):
+                s += self.data[y][x]
+                row[x+1] = above[x+1] + s
+            isum.append(row)
+        return isum
 
     def block_avg(self, x, y, szx, szy):
         """returns the average intensity of a block of size M{(szx,szy)} at pos (top-left) M{(x,y)}
 
         @rtype: float
         """
-        return float(sum([(self.xsum[y][x+szx] - self.xsum[y][x]) for y in range(y,y+szy)]))/(szx*szy)
+        S = self.isum
+        return float(S[y+szy][x+szx] - S[y][x+szx] - S[y+szy][x] + S[y][x])/(szx*szy)
 
     def lowest_block_avg(self, szx, szy, at_least = 0):
         """returns the M{(szx,szy)}-sized block with intensity as close to M{at_least} as possible
@@ -139,9 +257,23 @@ class PNMImage(object):
         @return: R=tuple M({avg, (szx_ratio,szy_ratio), (x,y), (szx,szy))}: R[0] is the
         average intensity of the block found, R[1] is the block size ratio with respect to the whole image,
         R[2] is the block position (top-left) and R[3] is the block size
+
+        Blocks are scanned row by row; the first block with the lowest intensity is returned, or
+        the first block that improves the running minimum to at most M{at_least}.
         """
         w,h = self.size
         best = (self.maxval,(1,1),(0,0),(szx,szy)) # avg, (szx_ratio,szy_ratio), (x,y), (szx,szy)
+        if numpy is not None:
+            S = self.isum
+            avg = (S[szy:,szx:] - S[:-szy,szx:] - S[szy:,:-szx] + S[:-szy,:-szx])/float(szx*szy)
+            avg = avg.ravel()
+            # a block at most at_least is always a new running minimum, unless it does not beat maxval
+            stop = numpy.flatnonzero((avg <= at_least) & (avg < self.maxval))
+            k = stop[0] if len(stop) else avg.argmin()
+            if avg[k] < best[0]:
+                y,x = divmod(int(k), w-szx+1)
+                best = (float(avg[k]), (float(szx)/w,float(szy)/h), (x,y), (szx,szy))
+            return best
         for y in range(0,h-szy+1):
             for x in range(0,w-szx+1):
                 cur = (self.block_avg(x,y,szx,szy), (float(szx)/w,float(szy)/h), (x,y), (szx,szy))
@@ -150,7 +282,45 @@ class PNMImage(object):
                     if best[0] <= at_least: return best
         return best
 
-    def fit_rect(self, size_range = (0.333, 0.8), at_least = 7, relax = 0.2, rr = 1.0):
+    def _best_blocks(self, szx, szy, xs, ys, keep):
+        """returns the I{keep} M{(szx,szy)}-sized blocks of lowest intensity, among positions M{xs*ys}
+
+        @param xs: range of x positions
+        @param ys: range of y positions
+        @rtype: [(float,int,int),...]
+        @return: list of tuples M{(avg,y,x)} sorted by intensity, then by position (row-major)
+        """
+        if numpy is not None:
+            S = self.isum
+            X = numpy.asarray(xs)
+            Y = numpy.asarray(ys)
+            avg = ((S[numpy.ix_(Y+szy,X+szx)] - S[numpy.ix_(Y,X+szx)] - S[numpy.ix_(Y+szy,X)] + S[numpy.ix_(Y,X)])
+                   /float(szx*szy)).ravel()
+            k = numpy.argsort(avg, kind='stable')[0:keep] if keep > 1 else [avg.argmin()]
+            return [(float(avg[i]), ys[i//len(xs)], xs[i%len(xs)]) for i in k]
+        return heapq.nsmallest(keep, ((self.block_avg(x,y,szx,szy), y, x) for y in ys for x in xs))
+
+    def pyramid_block_avg(self, szx, szy, step, keep = 4):
+        """coarse-to-fine version of L{lowest_block_avg}, without early stop
+
+        Blocks are first scanned at positions multiple of I{step}; then, the neighborhood of
+        the I{keep} best blocks found is scanned exhaustively. The result is usually, but not
+        always, the global minimum.
+
+        @rtype: (float,(float,float),(int,int),(int,int))
+        """
+        w,h = self.size
+        best = (self.maxval,(1,1),(0,0),(szx,szy))
+        found = []
+        for a, y0, x0 in self._best_blocks(szx, szy, range(0,w-szx+1,step), range(0,h-szy+1,step), keep):
+            found += self._best_blocks(szx, szy, range(max(0,x0-step+1), min(w-szx,x0+step-1)+1),
+                                       range(max(0,y0-step+1), min(h-szy,y0+step-1)+1), 1)
+        a, y, x = min(found)
+        if a < best[0]:
+            best = (a, (float(szx)/w,float(szy)/h), (x,y), (szx,szy))
+        return best
+
+    def fit_rect(self, size_range = (0.333, 0.8), at_least = 7, relax = 0.2, rr = 1.0, search = 'exact'):
         """find the maximal-area minimal-entropy rectangle within the image
 
         @param size_range: tuple of smallest and largest rect/photo size ratio
@@ -164,27 +334,55 @@ class PNMImage(object):
 
         Calendar rectangle ratio over Photo ratio. If M{r>1} then calendar rectangle, when scaled, fits
         M{x} dimension first. Conversely, if M{r<1}, scaling touches the M{y} dimension first. When M{r=1},
-        calendar rectangle can fit perfectly within the photo at 100% size.
+        calendar rectangle can fit perfectly within the photo at 100% size. The image may be non-square
+        (see L{_IM_quant_geometry}); its own aspect ratio is only used to convert the size of the fitted
+        dimension to the size of the other one.
+
+        @param search: C{'exact'} to scan every position and size, or C{'pyramid'} for
+        coarse-to-fine search, see L{pyramid_block_avg}; the pyramid step also applies to sizes,
+        i.e. only every I{step}-th size is tried, until the threshold is met, and then the sizes
+        skipped in between are tried
 
         @rtype: (float,(float,float),(int,int),(int,int),float)
         """
         w,h = self.size
-        sz_lo = _bound(int(w*size_range[0]+0.5),1,w)
-        sz_hi = _bound(int(w*size_range[1]+0.5),1,w)
-        szv_range = list(range(sz_lo, sz_hi+1))
-        if rr == 1:
-            sz_range = list(zip(szv_range, szv_range))
-        elif rr > 1:
-            sz_range = list(zip(szv_range, [_bound(int(x/rr+0.5),1,w) for x in szv_range]))
+        # block ratio (in cells) of the rectangle; sizes are measured on the dimension
+        # that the rectangle fits first, which depends on rr only, not on the map shape
+        g = rr*w/h
+        if rr >= 1:
+            sz_lo = _bound(int(w*size_range[0]+0.5),1,w)
+            sz_hi = _bound(int(w*size_range[1]+0.5),1,w)
+            szv_range = list(range(sz_lo, sz_hi+1))
+            sz_range = list(zip(szv_range, [_bound(int(x/g+0.5),1,h) for x in szv_range]))
         else:
-            sz_range = list(zip([_bound(int(x*rr+0.5),1,w) for x in szv_range], szv_range))
-        best = self.lowest_block_avg(*sz_range[0])
+            sz_lo = _bound(int(h*size_range[0]+0.5),1,h)
+            sz_hi = _bound(int(h*size_range[1]+0.5),1,h)
+            szv_range = list(range(sz_lo, sz_hi+1))
+            sz_range = list(zip([_bound(int(x*g+0.5),1,w) for x in szv_range], szv_range))
+        if search == 'pyramid':
+            step = max(2, int(sqrt(sqrt(w*h))/4 + 0.5))
+            lowest = lambda szx, szy: self.pyramid_block_avg(szx, szy, step)
+        else:
+            step = 1
+            lowest = self.lowest_block_avg
+        best = lowest(*sz_range[0])
         # we do not use at_least because non-global minimum, when relaxed, may jump well above threshold
         entropy_thres = max(at_least, best[0]*(1+relax))
-        for sz in list(reversed(sz_range))[0:-1]:
+        candidates = list(reversed(sz_range))[0:-1]
+        tried = 0
+        for i in list(range(0, len(candidates), step)) + [len(candidates)]:
+            if i == len(candidates):
+                if tried == len(candidates): break
+                i = len(candidates) - 1
             # we do not use at_least because we want the best possible option, for bigger sizes
-            cur = self.lowest_block_avg(*sz)
-            if cur[0] <= entropy_thres: return cur + (best[0],)
+            cur = lowest(*candidates[i])
+            if cur[0] <= entropy_thres:
+                # try bigger sizes skipped by the coarse step
+                for sz in candidates[tried:i]:
+                    cur2 = lowest(*sz)
+                    if cur2[0] <= entropy_thres: return cur2 + (best[0],)
+                return cur + (best[0],)
+            tried = i + 1
         return best + (best[0],) # avg, (szx_ratio,szy_ratio), (x,y), (szx,szy), best_avg
 
 
@@ -210,7 +408,10 @@ months are requested.""", version="callirhoe.CalMagick " + lib._version + '\n' +
                     "if input photos are reused in round-robin; "
                     "'auto' adds YEAR_MONTH_ prefix only when input photos are randomized or more months than photos are requested; 'yes' will always add prefix [%default]")
     parser.add_option("--quantum", type="int", default=60,
-                    help="choose quantization level for entropy computation [%default]")
+                    help="choose quantization level for entropy computation; the entropy map has about QUANTUM*QUANTUM cells, "
+                    "laid out according to the photo aspect ratio [%default]")
+    parser.add_option("--square-grid", action="store_true", default=False,
+                    help="quantize the entropy map in a QUANTUM x QUANTUM grid, regardless of the photo aspect ratio")
     parser.add_option("--placement", type="choice", choices="min max N S W E NW NE SW SE center random".split(),
                     default="min", help="choose placement algorithm among {min, max, "
                     "N, S, W, E, NW, NE, SW, SE, center, random} [%default]")
@@ -232,17 +433,56 @@ months are requested.""", version="callirhoe.CalMagick " + lib._version + '\n' +
     parser.add_option("--negative",  type="float", default=100,
                     help="average luminosity (0-255) threshold of the overlaid area, below which a negative "
                     "overlay is chosen [%default]")
-    parser.add_option("--test",  type="choice", choices="none area quant quantimg print crop".split(), default='none',
+    parser.add_option("--proxy-size", type="int", default=0,
+                    help="decode JPEG photos at reduced size (DCT scaling), no smaller than PROXY_SIZE x PROXY_SIZE pixels, for "
+                    "entropy and luminance analysis; only the final composition reads the full-size photo; this saves time "
+                    "and memory for very large photos; 0 disables; ignored when --pre-magick arguments are given [%default]")
+    parser.add_option("--search", type="choice", choices=['exact','pyramid'], default='exact',
+                    help="choose search method for min/max placement: 'exact' tries every position and size of the "
+                    "calendar rectangle; 'pyramid' tries a coarse grid of positions and sizes first and refines the best "
+                    "candidates, which is much faster for large QUANTUM but may miss the optimum [%default]")
+    parser.add_option("--test",  type="choice", choices="none area quant quantimg print crop search".split(), default='none',
                     help="test entropy minimization algorithm, without creating any calendar, TEST should be among "
-                    "{none, area, quant, quantimg, print, crop}: none=test disabled; "
+                    "{none, area, quant, quantimg, print, crop, search}: none=test disabled; "
                     "area=show area in original image; quant=show area in quantizer; "
                     "quantimg=show both quantizer and image; print=print minimum entropy area in STDOUT as W H X Y, "
-                    "without generating any files at all; crop=crop selected area [%default]")
+                    "without generating any files at all; crop=crop selected area; search=compare pyramid with "
+                    "exact search in STDOUT (entropy, position, size and time), without generating any files [%default]")
     parser.add_option("--alt",  action="store_true", default=False,
                     help="use an alternate entropy computation algorithm; although for most cases it should be no better than the default one, "
                     "for some cases it might produce better results (yet to be verified)")
+    parser.add_option("--incremental", action="store_true", default=False,
+                    help="skip output images that are up to date, i.e. built by a previous run from the same photo (content), "
+                    "month, calendar and ImageMagick arguments, options and calmagick version; a manifest of built images "
+                    "is kept in file .calmagick-manifest.jsonl of the output directory")
+    parser.add_option("--journal", default=None, metavar="FILE",
+                    help="log completed and failed items of a --range run in FILE, so that the run can be resumed; "
+                    "by default, .calmagick-journal.jsonl of the output directory is used (.calmagick-journal.HOST.PID.jsonl with --spool)")
+    parser.add_option("--resume", action="store_true", default=False,
+                    help="resume an interrupted --range run, skipping photos already composed according to the journal "
+                    "(see --journal); without this option, a new journal is started; with --spool, photos marked as done "
+                    "in the spool are skipped, and photos marked as failed are tried again")
+    parser.add_option("--retries", type="int", default=2,
+                    help="retry a failed photo composition this many times, before recording it as failed in the "
+                    "journal and moving on to the next photo [%default]")
+    parser.add_option("--spool", default=None, metavar="DIR",
+                    help="share the photos of a --range run among several calmagick processes, possibly on different hosts, "
+                    "started with the same arguments: each photo is composed by the first process that claims it, with "
+                    "a lease file in directory DIR, which should be on a file system shared by all hosts, like the output directory")
+    parser.add_option("--lease-time", type="int", default=300,
+                    help="consider a claimed photo abandoned (e.g. its host crashed) if its lease has not been renewed for this "
+                    "many seconds; leases are renewed every LEASE_TIME/3 seconds while composing, and a process whose lease has been "
+                    "taken over abandons the photo without writing its output [%default]")
+    parser.add_option("--cache", default=None,
+                    help="keep photo analysis results (placement and luminance) in this SQLite database, e.g. "
+                    "~/.callirhoe/calmagick.db, so that they are reused by subsequent runs; results are "
+                    "indexed by photo content and placement options (random placement is never cached)")
     parser.add_option("-v", "--verbose",  action="store_true", default=False,
                     help="print progress messages")
+    parser.add_option("--profile", default=None, metavar="FILE",
+                    help="record the wall, CPU and child process time of every composition step (analysis, placement search, "
+                    "luminance, rendering, composition) of every photo in FILE, as JSON lines, and print a summary "
+                    "with percentiles in STDERR at the end")
 
     cal = optparse.OptionGroup(parser, "Calendar Options", "These options determine how callirhoe is invoked.")
     cal.add_option("-s", "--style", default="transparent",
@@ -260,6 +500,14 @@ photos.""")
     cal.add_option('-j', "--jobs", type="int", default=1,
                     help="set parallel job count (total number of threads) for the --range iteration; although python "
                     "threads are not true processes, they help running the external programs efficiently [%default]")
+    cal.add_option("--analysis-jobs", type="int", default=0,
+                    help="set maximum number of concurrent photo analysis (ImageMagick) tasks; 0=JOBS [%default]")
+    cal.add_option("--render-jobs", type="int", default=0,
+                    help="set maximum number of concurrent calendar rendering tasks; 0=JOBS [%default]")
+    cal.add_option("--compose-jobs", type="int", default=0,
+                    help="set maximum number of concurrent final composition (ImageMagick) tasks; 0=JOBS; "
+                    "unless MAGICK_THREAD_LIMIT is set, ImageMagick threads are limited so that concurrent "
+                    "analysis and composition tasks do not oversubscribe the available CPUs [%default]")
     cal.add_option("--sample", type="int", default=None,
                     help="choose SAMPLE random images from the input and use in round-robin fashion (see --range option); if "
                     "SAMPLE=0 then the sample size is chosen to as big as possible, either equal to the month span defined with --range, or "
@@ -269,8 +517,14 @@ photos.""")
                     "the sample size is chosen to be equal to the month span defined with --range or equal to "
                     "the total number of available photos (whichever is smaller); this "
                     "is equivalent to specifying --sample=0")
+    cal.add_option("--no-overlay-cache", action="store_true", default=False,
+                    help="render every calendar from scratch, instead of reusing calendars of the same "
+                    "month, size and arguments rendered before")
     cal.add_option("--vanilla", action="store_true", default=False,
                     help="suppress default options --no-footer --border=0")
+    cal.add_option("--spawn-callirhoe", action="store_true", default=False,
+                    help="launch an external callirhoe process for every calendar, instead of rendering "
+                    "in-process; this is also the fallback when callirhoe cannot be imported (e.g. pycairo is missing)")
     parser.add_option_group(cal)
 
     im = optparse.OptionGroup(parser, "ImageMagick Options", "These options determine how ImageMagick is used.")
@@ -286,6 +540,10 @@ photos.""")
                     "to this value (percent) [%default]")
 #    im.add_option("--radius",  type="float", default=2,
 #                    help="radius for the entropy computation algorithm [%default]")
+    im.add_option("--compositor", type="choice", choices=['magick','cairo'], default='magick',
+                    help="choose the backend for the final composition: 'magick' runs ImageMagick on the photo, 'cairo' "
+                    "adjusts the overlaid area and composes the calendar in-process, so that the photo is decoded and "
+                    "encoded only once (requires pycairo and NumPy; falls back to 'magick' when --in-magick is used) [%default]")
     im.add_option("--pre-magick",  action="store_true", default=False,
                     help="pass all subsequent arguments to ImageMagick, before entropy computation; should precede --in-magick and --post-magick")
     im.add_option("--in-magick",  action="store_true", default=False,
@@ -307,6 +565,20 @@ def check_parsed_options(options):
         raise lib.Abort("calmagick: you cannot specify both --outfile and --range options")
     if options.sample is not None and options.shuffle:
         raise lib.Abort("calmagick: you cannot specify both --shuffle and --sample options")
+    if options.resume and not options.range:
+        raise lib.Abort("calmagick: --resume requested without --range")
+    if options.resume and (options.sample is not None or options.shuffle):
+        raise lib.Abort("calmagick: a run with random photo selection (--sample, --shuffle) cannot be resumed")
+    if options.retries < 0: options.retries = 0
+    if options.spool:
+        if not options.range:
+            raise lib.Abort("calmagick: --spool requested without --range")
+        if options.sample is not None or options.shuffle:
+            raise lib.Abort("calmagick: workers sharing a spool need the same photo order; --sample and --shuffle are not supported")
+        if options.incremental:
+            raise lib.Abort("calmagick: you cannot specify both --spool and --incremental options")
+        if options.lease_time < 3:
+            raise lib.Abort("calmagick: --lease-time should be at least 3 seconds")
     if options.shuffle:
         options.sample = 0
     if options.sample is None:
@@ -314,6 +586,11 @@ def check_parsed_options(options):
     else:
         if options.prefix == 'auto': options.prefix = 'yes'
     if options.jobs < 1: options.jobs = 1
+    if options.compositor == 'cairo' and (cairo is None or numpy is None):
+        raise lib.Abort("calmagick: --compositor=cairo requires pycairo and NumPy")
+    for x in ['analysis_jobs', 'render_jobs', 'compose_jobs']:
+        n = getattr(options, x)
+        setattr(options, x, options.jobs if n < 1 else min(n, options.jobs))
 
 def parse_magick_args():
     """extract arguments from command-line that will be passed to ImageMagick
@@ -405,6 +682,16 @@ _IM_entropy_tail = "-colorspace Lab -channel R -separate +channel -set colorspac
 """IM entropy computation final colorspace"""
 #_IM_entropy_tail = "-colorspace Lab -channel R -separate +channel -normalize -scale".split()
 
+def _IM_quant_geometry(options):
+    """IM geometry argument for the final scaling of the entropy map
+
+    The map has about M{q*q} cells, where M{q} the quantization level (C{--quantum}), with
+    the same aspect ratio as the photo, unless C{--square-grid} is given.
+
+    @rtype: str
+    """
+    return '%dx%d!' % ((options.quantum,)*2) if options.square_grid else '%d@' % options.quantum**2
+
 def _IM_entropy_args(alt=False):
     """IM entropy computation arguments, depending on default or alternate algorithm
 
@@ -412,13 +699,91 @@ def _IM_entropy_args(alt=False):
     """
     return _IM_entropy_head + _IM_entropy_alg[alt] + _IM_entropy_tail
 
-def _entropy_placement(img, size, args, options, r):
-    """get rectangle of minimal/maximal entropy
+_lum_map_size = 128
+"""size of the (square) luminance map computed by L{_IM_analyze}"""
+
+def _IM_ping_size(img):
+    """extract tuple(width,height) from image file header using ImageMagick, without decoding the image
+
+    @rtype: (int,int)
+    """
+    info = subprocess.check_output([_prog_im, '-ping', img, '-format', '%w %h\n', 'info:']).split()
+    return tuple(map(int, info[0:2]))
+
+def _IM_analyze(img, args, options, entropy = True, luminance = True, proxy = 0):
+    """analyze a photo with a single ImageMagick invocation, thus decoding it only once
+
+    If I{proxy} is non-zero, JPEG photos are decoded at reduced size (DCT scaling), no smaller
+    than I{proxy}x{proxy} pixels, while the photo size is read from the file header. This is
+    valid only if there are no pre-processing arguments changing the image size.
 
     @param img: image file
-    @param size: image size tuple(I{width,height})
     @param args: ImageMagick pre-processing argument list (see C{--pre-magick})
     @param options: (command-line) options object
+    @param entropy: compute the quantized entropy map
+    @param luminance: compute the luminance map, see L{_region_luminance}
+    @param proxy: minimum size of the reduced-size image to decode, 0 to decode at full size
+    @rtype: ((int,int),PNMImage,PNMImage)
+    @return: tuple (I{size,entropy_map,luminance_map}), where I{size} is the image size
+    tuple(I{width,height}) and the maps are C{None} if not requested
+    """
+    if proxy:
+        cmd = [_prog_im, '-define', 'jpeg:size=%dx%d' % (proxy,proxy), img] + args + ['-print', '%w %h\n']
+    else:
+        cmd = [_prog_im, img] + args + ['-print', '%w %h\n']
+    if entropy:
+        qresize = _IM_quant_geometry(options)
+        cmd += ['(', '-clone', '0'] + _IM_entropy_args(options.alt) + [qresize, '-normalize'] + (
+            ['-negate'] if options.placement == 'max' else []) + [')']
+    if luminance:
+        cmd += ['(', '-clone', '0'] + _IM_lum_args + ['-scale', '%dx%d!' % ((_lum_map_size,)*2), ')']
+    if entropy or luminance:
+        cmd += ['-delete', '0', 'pgm:-']
+    else:
+        cmd += ['null:']
+    out = subprocess.check_output(cmd)
+    eol = out.index(b'\n')
+    if proxy:
+        with _profile('probe'):
+            size = _IM_ping_size(img)
+    else:
+        size = tuple(map(int, out[0:eol].split()))
+    frames = [PNMImage(f) for f in _pnm_frames(memoryview(out)[eol+1:])]
+    if len(frames) != int(entropy) + int(luminance):
+        raise RuntimeError("calmagick: unexpected ImageMagick analysis output")
+    return (size, frames[0] if entropy else None, frames[-1] if luminance else None)
+
+def _region_luminance(lmap, size, geometry):
+    """get average luminance of a photo region as a float in [0,255], from a luminance map
+
+    Map pixels partially covered by the region contribute proportionally to their coverage.
+
+    @param lmap: luminance map (L{PNMImage}) of the whole photo
+    @param size: photo size tuple(I{width,height})
+    @param geometry: IM geometry tuple(I{width,height,x,y}) of the region
+    @rtype: float
+    """
+    def weights(x, w, n, N):
+        # coverage of each map pixel by [x,x+w), with photo length N mapped to n pixels
+        x0, x1 = float(x)*n/N, float(x+w)*n/N
+        return [max(0.0, min(x1, i+1) - max(x0, i)) for i in range(n)]
+    mw, mh = lmap.size
+    wx = weights(geometry[2], geometry[0], mw, size[0])
+    wy = weights(geometry[3], geometry[1], mh, size[1])
+    total = sum(wx)*sum(wy)
+    if total == 0: return 0.0
+    if numpy is not None:
+        s = float(numpy.dot(numpy.dot(wy, lmap.data), wx))
+    else:
+        s = sum(wy[y]*sum(wx[x]*lmap.data[y][x] for x in range(mw)) for y in range(mh) if wy[y] > 0)
+    return 255.0*s/total/lmap.maxval
+
+def _entropy_placement(pnm_entropy, size, options, r):
+    """get rectangle of minimal/maximal entropy
+
+    @param pnm_entropy: quantized entropy map (L{PNMImage}), see L{_IM_analyze}
+    @param size: image size tuple(I{width,height})
+    @param options: (command-line) options object
     @param r: rectangle ratio, 0=match input ratio
     @rtype: (int,int,int,int)
     @return: IM geometry tuple(I{width,height,x,y})
@@ -426,15 +791,24 @@ def _entropy_placement(img, size, args, options, r):
     w,h = size
     R = float(w)/h
     if r == 0: r = R
-    if options.verbose:
-        print("Calculating image entropy...")
-    qresize = '%dx%d!' % ((options.quantum,)*2)
-    pnm_entropy = PNMImage(subprocess.check_output([_prog_im, img] + args + _IM_entropy_args(options.alt) +
-    [qresize, '-normalize'] + (['-negate'] if options.placement == 'max' else []) + "-compress None pnm:-".split()).splitlines())
 
     # find optimal fit
     if options.verbose: print("Fitting... ", end=' ')
-    best = pnm_entropy.fit_rect((options.min_size,options.max_size), options.low_entropy, options.relax, r/R)
+    fit_args = ((options.min_size,options.max_size), options.low_entropy, options.relax, r/R)
+    if options.test == 'search':
+        res = dict()
+        for search in ['exact', 'pyramid']:
+            t0 = time.time()
+            res[search] = pnm_entropy.fit_rect(*fit_args, search = search)
+            print("%s: ent=%0.2f pos=(%d,%d) bs=(%d,%d) time=%0.3fs" % (search, res[search][0],
+                  res[search][2][0], res[search][2][1], res[search][3][0], res[search][3][1], time.time() - t0), end='; ')
+        e, p = res['exact'], res['pyramid']
+        print("pyramid-exact: ent=%+0.2f (%+0.1f%%) pos=(%+d,%+d) area=%+0.1f%%" % (p[0] - e[0],
+              100.0*(p[0] - e[0])/e[0] if e[0] else 0, p[2][0] - e[2][0], p[2][1] - e[2][1],
+              100.0*(p[3][0]*p[3][1] - e[3][0]*e[3][1])/(e[3][0]*e[3][1])))
+        best = res[options.search]
+    else:
+        best = pnm_entropy.fit_rect(*fit_args, search = options.search)
     if options.verbose:
         print("ent=%0.2f frac=(%0.2f,%0.2f) pos=(%d,%d) bs=(%d,%d) min=%0.2f r=%0.2f" % (
             best[0], best[1][0], best[1][1], best[2][0], best[2][1], best[3][0], best[3][1], best[4], R*best[3][0]/best[3][1]))
@@ -482,6 +856,163 @@ _cache = dict() # {'filename': (geometry, is_dark)}
 _mutex = threading.Lock()
 """mutex for cache access"""
 
+class StageLimiter(object):
+    """limit the number of concurrently running tasks of each composition stage
+
+    Stages are C{analysis} (ImageMagick photo analysis), C{render} (calendar rendering) and
+    C{compose} (ImageMagick final composition). Worker threads enter a stage with L{stage},
+    blocking while the stage is full.
+
+    @ivar limits: maximum number of concurrent tasks, indexed by stage name
+    @ivar running: number of running tasks, indexed by stage name
+    @ivar waiting: number of tasks waiting to enter, indexed by stage name
+    @ivar max_waiting: maximum observed L{waiting} value (queue depth), indexed by stage name
+    @ivar verbose: report queue depth whenever a task enters a stage
+    """
+    def __init__(self, limits, verbose = False):
+        self.limits = dict(limits)
+        self._sem = dict((k, threading.BoundedSemaphore(v)) for k,v in limits.items())
+        self._lock = threading.Lock()
+        self.running = dict.fromkeys(limits, 0)
+        self.waiting = dict.fromkeys(limits, 0)
+        self.max_waiting = dict.fromkeys(limits, 0)
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def stage(self, name, step = None):
+        """context manager running its block as a task of stage I{name}
+
+        @param step: name under which the task is recorded by L{_profiler}, if profiling is
+        enabled (C{--profile}); defaults to I{name}
+        """
+        t0 = time.time()
+        with self._lock:
+            self.waiting[name] += 1
+            self.max_waiting[name] = max(self.max_waiting[name], self.waiting[name])
+        self._sem[name].acquire()
+        with self._lock:
+            self.waiting[name] -= 1
+            self.running[name] += 1
+            if self.verbose:
+                print("[%s] %d/%d running, %d queued" % (name, self.running[name], self.limits[name], self.waiting[name]))
+        try:
+            with _profile(step or name, time.time() - t0):
+                yield
+        finally:
+            with self._lock:
+                self.running[name] -= 1
+            self._sem[name].release()
+
+    def report(self):
+        """return a summary of stage limits and maximum queue depths
+
+        @rtype: str
+        """
+        return ', '.join("%s: %d jobs, max queue %d" % (k, self.limits[k], self.max_waiting[k])
+                         for k in sorted(self.limits))
+
+_stages = StageLimiter(dict(analysis=1, render=1, compose=1))
+"""L{StageLimiter} object used by L{compose_calendar}"""
+
+def _percentile(values, p):
+    """returns the I{p}-th percentile (nearest rank) of a sorted list of values
+
+    @rtype: float
+    """
+    if not values: return 0.0
+    return values[_bound(int(len(values)*p/100.0 + 0.999999) - 1, 0, len(values) - 1)]
+
+class Profiler(object):
+    """record the time spent in each step of photo composition, as JSON lines (see C{--profile})
+
+    Every record holds the photo, the step name, its start time (relative to profiler creation),
+    wall time, CPU time of the calling thread, CPU time of child processes (ImageMagick,
+    callirhoe) and the time spent waiting for a free slot of the L{StageLimiter} stage.
+    Steps are C{lookup} (persistent cache lookup), C{analysis} (ImageMagick analysis, including
+    C{probe}, the photo size probing when decoding at reduced size), C{fit} (placement search),
+    C{luminance}, C{render} (calendar rendering), C{compose} (final composition) and C{total}
+    (the whole L{compose_calendar} call).
+
+    @note: child process times are collected process-wide, so they are only approximate when
+    several jobs run concurrently (C{--jobs}).
+    @ivar records: list of tuples I{(step, wall, cpu, children, wait)} of all recorded steps
+    """
+    def __init__(self, filename):
+        self._file = open(filename, 'w', buffering = 1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.time()
+        self.records = []
+
+    def close(self):
+        """close the profile file"""
+        self._file.close()
+
+    @contextlib.contextmanager
+    def photo(self, img):
+        """context manager attributing the steps run by the current thread to photo I{img}
+
+        The whole block is recorded as step C{total}, along with the exception raised, if any.
+        """
+        self._local.photo = img
+        try:
+            with self.measure('total') as rec:
+                try:
+                    yield
+                except Exception as e:
+                    rec['error'] = str(e)
+                    raise
+        finally:
+            self._local.photo = None
+
+    @contextlib.contextmanager
+    def measure(self, step, wait = 0.0):
+        """context manager recording its block as step I{step}
+
+        @param wait: time spent waiting before the block was entered (queue time)
+        """
+        rec = dict(photo = getattr(self._local, 'photo', None), step = step, thread = threading.current_thread().name)
+        t0, c0, k0 = time.time(), time.thread_time(), os.times()
+        try:
+            yield rec
+        finally:
+            t1, c1, k1 = time.time(), time.thread_time(), os.times()
+            rec.update(start = round(t0 - self._t0, 6), wall = round(t1 - t0, 6), cpu = round(c1 - c0, 6),
+                       children = round(k1.children_user + k1.children_system - k0.children_user - k0.children_system, 6),
+                       wait = round(wait, 6))
+            with self._lock:
+                self.records.append((step, rec['wall'], rec['cpu'], rec['children'], rec['wait']))
+                self._file.write(json.dumps(rec) + '\n')
+
+    def summary(self):
+        """return a table with count, total and percentiles of wall time, and total CPU and queue time, per step
+
+        @rtype: str
+        """
+        steps = OrderedDict()
+        for r in self.records:
+            steps.setdefault(r[0], []).append(r)
+        lines = ["%-10s %6s %9s %8s %8s %8s %8s %9s %9s %9s" % ('step', 'count', 'wall', 'p50', 'p90', 'p99',
+                 'max', 'cpu', 'children', 'wait')]
+        for step, recs in steps.items():
+            walls = sorted(r[1] for r in recs)
+            lines.append("%-10s %6d %9.3f %8.3f %8.3f %8.3f %8.3f %9.3f %9.3f %9.3f" % (step, len(recs), sum(walls),
+                         _percentile(walls, 50), _percentile(walls, 90), _percentile(walls, 99), walls[-1],
+                         sum(r[2] for r in recs), sum(r[3] for r in recs), sum(r[4] for r in recs)))
+        return '\n'.join(lines)
+
+_profiler = None
+"""L{Profiler} object, if profiling is enabled (C{--profile})"""
+
+@contextlib.contextmanager
+def _profile(step, wait = 0.0):
+    """context manager recording its block as step I{step} with L{_profiler}, if profiling is enabled"""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.measure(step, wait):
+            yield
+
 def get_cache(num_photos, num_months):
     """returns a reference to the cache object, or None if caching is disabled
 
@@ -493,7 +1024,555 @@ def get_cache(num_photos, num_months):
     if q < 1 or r == 0: return None
     return _cache if (num_photos / r <= 6) else None;
 
-def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=None, cache=None):
+def _file_digest(path):
+    """return the SHA-1 digest of a file, as hex string
+
+    @rtype: str
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class AnalysisCache(object):
+    """persistent cache of photo analysis results, stored in an SQLite database
+
+    Results are indexed by photo content (SHA-1 digest) and by the options affecting
+    placement, so that they survive renaming and are invalidated by any modification
+    of the photo. Digests are remembered along with file size and modification time,
+    so that unchanged photos are not read again.
+
+    @ivar db: C{sqlite3.Connection} object
+    @ivar lock: mutex for database access
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+                            "mtime INTEGER, digest TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS analysis (digest TEXT, params TEXT, "
+                            "width INTEGER, height INTEGER, geometry TEXT, luma REAL, PRIMARY KEY (digest, params))")
+
+    def _digest(self, img):
+        """return the SHA-1 digest of file I{img}, computing it only if the file has been modified
+
+        @rtype: str
+        """
+        path = os.path.realpath(img)
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        digest = _file_digest(path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def key(self, img, options, args):
+        """return the cache key for photo I{img}
+
+        @param args: ImageMagick pre-processing argument list (see C{--pre-magick})
+        @rtype: (str,str)
+        """
+        params = json.dumps([options.quantum, options.square_grid, options.placement, options.min_size, options.max_size,
+                             options.ratio, options.alt, options.low_entropy, options.relax, options.search,
+                             0 if args else options.proxy_size, args])
+        return (self._digest(img), params)
+
+    def get(self, key):
+        """look up an analysis result
+
+        @rtype: ((int,int),(int,int,int,int),float)
+        @return: tuple (I{size,geometry,luma}), where I{luma} may be C{None} if not measured,
+        or C{None} if I{key} is not found
+        """
+        with self.lock:
+            row = self.db.execute("SELECT width, height, geometry, luma FROM analysis WHERE digest = ? AND params = ?",
+                                  key).fetchone()
+        if row is None: return None
+        return (row[0], row[1]), tuple(json.loads(row[2])), row[3]
+
+    def put(self, key, size, geometry, luma):
+        """store an analysis result, see L{get}"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?)",
+                            key + (size[0], size[1], json.dumps(geometry), luma))
+
+_analysis_cache = None
+"""persistent L{AnalysisCache} object, or C{None} if disabled (see C{--cache})"""
+
+class Manifest(object):
+    """record of the inputs each output image was built from, kept as JSON lines file in the output directory
+
+    Used by C{--incremental} to skip output images that are up to date, i.e. that exist
+    and have been built from the same photo (content), calendar arguments, ImageMagick
+    arguments, options and calmagick version.
+
+    Every built image is appended to the file as a single line; when loaded, later lines
+    supersede earlier ones for the same image, and the file is compacted if it contains
+    superseded (or torn) lines.
+
+    @ivar filename: manifest file name
+    @ivar entries: dict of I{{'fingerprint','photo','size','mtime','digest'}} dicts, indexed by output file name
+    @ivar lock: mutex for entry access
+    """
+    # options that do not affect the output image
+    _ignored_options = set(['verbose', 'jobs', 'analysis_jobs', 'render_jobs', 'compose_jobs', 'incremental',
+                            'cache', 'outdir', 'outfile', 'prefix', 'range', 'sample', 'shuffle',
+                            'spawn_callirhoe', 'no_overlay_cache', 'profile', 'journal', 'resume', 'retries',
+                            'spool', 'lease_time'])
+
+    def __init__(self, outdir):
+        self.filename = os.path.join(outdir, '.calmagick-manifest.jsonl')
+        self.lock = threading.Lock()
+        self.entries = dict()
+        lines = 0
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        e = json.loads(line)
+                        self.entries[e.pop('outfile')] = e
+                    except (ValueError, KeyError, AttributeError):
+                        continue
+        except IOError:
+            pass
+        if lines > len(self.entries):
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                for outimg, e in sorted(self.entries.items()):
+                    f.write(self._line(outimg, e))
+            os.replace(tmp, self.filename)
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def close(self):
+        """close the manifest file"""
+        os.close(self._fd)
+
+    @staticmethod
+    def _line(outimg, entry):
+        """returns the manifest line of an entry
+
+        @rtype: str
+        """
+        return json.dumps(dict(entry, outfile = outimg), sort_keys=True) + '\n'
+
+    def _photo_digest(self, img, outimg):
+        """return photo content digest, reusing the recorded one if the photo is unmodified
+
+        @rtype: (str,os.stat_result)
+        """
+        st = os.stat(img)
+        with self.lock:
+            e = self.entries.get(outimg)
+        if e and e['photo'] == img and e['size'] == st.st_size and e['mtime'] == st.st_mtime_ns:
+            return e['digest'], st
+        return _file_digest(img), st
+
+    def fingerprint(self, img, outimg, options, callirhoe_args, magick_args):
+        """compute the fingerprint of the inputs of I{outimg}
+
+        @rtype: (str,dict)
+        @return: tuple (I{fingerprint,entry}), where I{entry} should be passed to L{update}
+        """
+        digest, st = self._photo_digest(img, outimg)
+        opts = sorted((k,v) for k,v in vars(options).items() if k not in Manifest._ignored_options)
+        fp = hashlib.sha1(json.dumps([digest, callirhoe_args, magick_args, opts, lib._version]).encode('utf-8')).hexdigest()
+        return fp, dict(fingerprint = fp, photo = img, size = st.st_size, mtime = st.st_mtime_ns, digest = digest)
+
+    def up_to_date(self, outimg, fingerprint):
+        """check whether I{outimg} exists and has been built with the given fingerprint
+
+        @rtype: bool
+        """
+        with self.lock:
+            e = self.entries.get(outimg)
+        return e is not None and e['fingerprint'] == fingerprint and os.path.exists(outimg)
+
+    def update(self, outimg, entry):
+        """record that I{outimg} has been built, appending it to the manifest file"""
+        line = self._line(outimg, entry).encode('utf-8')
+        with self.lock:
+            self.entries[outimg] = entry
+        os.write(self._fd, line)
+
+class Journal(object):
+    """log of the items of a C{--range} run, kept as JSON lines, so that an interrupted run can be resumed (see C{--resume})
+
+    Every finished item is appended as a single line I{{'photo','month','year','outfile','attempts'}},
+    plus I{'error'} if it failed, with one C{write()} call followed by C{fsync()}; a line torn
+    by a crash is ignored when the journal is loaded.
+
+    @ivar filename: journal file name
+    @ivar done: set of tuples I{(photo,month,year,outfile)} of successfully completed items
+    @ivar failed: list of tuples I{(photo,month,year,outfile,error)} of items failed in this run
+    """
+    def __init__(self, filename, resume = False):
+        self.filename = filename
+        self.done = set()
+        self.failed = []
+        self._lock = threading.Lock()
+        torn = False
+        if resume:
+            try:
+                with open(filename) as f:
+                    for line in f:
+                        torn = not line.endswith('\n')
+                        try:
+                            e = json.loads(line)
+                        except ValueError:
+                            continue
+                        key = (e['photo'], e['month'], e['year'], e['outfile'])
+                        if 'error' in e: self.done.discard(key)
+                        else: self.done.add(key)
+            except IOError:
+                pass
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC), 0o644)
+        # terminate a torn line, so that it does not swallow the next record
+        if torn: os.write(self._fd, b'\n')
+
+    def close(self):
+        """close the journal file"""
+        os.close(self._fd)
+
+    def is_done(self, img, month, year, outimg):
+        """check whether an item has been completed by a previous run, and its output still exists
+
+        @rtype: bool
+        """
+        return (img, month, year, outimg) in self.done and os.path.exists(outimg)
+
+    def record(self, img, month, year, outimg, attempts, error = None):
+        """append a finished item to the journal"""
+        e = dict(photo = img, month = month, year = year, outfile = outimg, attempts = attempts)
+        if error is not None: e['error'] = error
+        line = (json.dumps(e, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            if error is None: self.done.add((img, month, year, outimg))
+            else: self.failed.append((img, month, year, outimg, error))
+            os.write(self._fd, line)
+            os.fsync(self._fd)
+
+class Spool(object):
+    """queue of C{--range} items shared by workers on several hosts, through lease files in a (network) directory
+
+    Every item is named after its output file (see L{get_outfile}). A worker claims an item
+    by creating I{name}C{.lease} exclusively; while the item is being composed, the lease is
+    renewed (its modification time is updated) every third of the lease time. Leases not
+    renewed for more than the lease time belong to dead workers and are taken over. A worker
+    whose lease has been taken over abandons the item: its output is composed into a scratch
+    file (see L{scratch}), which is moved into place only if the lease is still held. Finished
+    items are marked with I{name}C{.done}, and items that failed (after retries) with
+    I{name}C{.failed}; both are skipped by all workers. When resuming (C{--resume}), failed
+    markers left by previous runs are ignored, i.e. failed items are tried again, once. Workers
+    running at the same time belong to the same run, whose id is recorded in the failed markers;
+    a worker that finds no other live worker starts a new run (see L{_join_run}).
+
+    Lease ages are measured with the clock of the file server, read from the modification
+    time of a probe file, so that clock skew between hosts does not matter.
+
+    @ivar directory: spool directory
+    @ivar lease_time: lease expiry time, in seconds
+    @ivar owner: lease owner id, I{host.pid}
+    @ivar resume: ignore failed markers of previous runs
+    @ivar run: run id, I{time.host.pid} of the worker that started the run
+    """
+    def __init__(self, directory, lease_time = 300, verbose = False, resume = False):
+        self.directory = directory
+        self.lease_time = lease_time
+        self.verbose = verbose
+        self.resume = resume
+        self.owner = '%s.%d' % (socket.gethostname(), os.getpid())
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._probe = os.path.join(directory, '.clock.' + self.owner)
+        open(self._probe, 'w').close()
+        self.run = self._join_run()
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def close(self):
+        """stop renewing leases and remove the probe file"""
+        self._stop.set()
+        self._heartbeat.join()
+        try:
+            os.remove(self._probe)
+        except OSError:
+            pass
+
+    def _path(self, name, ext):
+        """returns the path of spool file I{name}+I{ext}"""
+        return os.path.join(self.directory, name + ext)
+
+    def _server_time(self):
+        """returns the current time of the file server
+
+        @rtype: float
+        """
+        os.utime(self._probe, None)
+        return os.stat(self._probe).st_mtime
+
+    def _join_run(self):
+        """returns the id of the run of the live workers, or of a new run if there are none
+
+        Every worker keeps its run id in its probe file, which is touched by the heartbeat
+        (see L{_renew}); probe files not touched for more than the lease time belong to dead
+        workers. Workers starting at the same time are serialized with the lease of C{.run}.
+
+        @rtype: str
+        """
+        while not self._create_lease('.run'):
+            if not self._take_over('.run'): time.sleep(0.1)
+        try:
+            now = self._server_time()
+            runs = []
+            for f in os.listdir(self.directory):
+                probe = os.path.join(self.directory, f)
+                if not f.startswith('.clock.') or probe == self._probe: continue
+                try:
+                    with open(probe) as p:
+                        run = p.read()
+                    if run and now - os.stat(probe).st_mtime <= self.lease_time: runs.append(run)
+                except OSError:
+                    pass
+            run = min(runs) if runs else '%017.6f.%s' % (now, self.owner)
+            with open(self._probe, 'w') as p:
+                p.write(run)
+        finally:
+            os.remove(self._path('.run', '.lease'))
+        return run
+
+    def _renew(self):
+        """heartbeat thread, renewing the leases held and the probe file"""
+        while not self._stop.wait(self.lease_time/3.0):
+            try:
+                os.utime(self._probe, None)
+            except OSError:
+                pass
+            with self._lock:
+                held = list(self._held)
+            for name in held:
+                try:
+                    if self._lease_owner(name) != self.owner: raise FileNotFoundError
+                    os.utime(self._path(name, '.lease'), None)
+                except OSError:
+                    # taken over by another worker, the item is abandoned
+                    with self._lock:
+                        self._held.discard(name)
+                    print("calmagick: lost lease of %s" % name, file=sys.stderr)
+
+    def _lease_owner(self, name):
+        """returns the owner of the lease of an item, C{None} if not leased
+
+        @rtype: str
+        """
+        try:
+            with open(self._path(name, '.lease'), 'rb') as f:
+                return f.read().decode('utf-8', 'replace')
+        except OSError:
+            return None
+
+    def _create_lease(self, name):
+        """try to create the lease file of an item exclusively
+
+        @rtype: bool
+        """
+        try:
+            fd = os.open(self._path(name, '.lease'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        os.write(fd, self.owner.encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _take_over(self, name):
+        """remove the lease of an item if it has expired
+
+        The lease is renamed to a name unique to this worker, so that only one worker removes
+        it; if it turns out to have been renewed in the meantime, it is restored.
+
+        @rtype: bool
+        @return: C{True} if an expired lease was removed
+        """
+        lease = self._path(name, '.lease')
+        try:
+            age = self._server_time() - os.stat(lease).st_mtime
+        except FileNotFoundError:
+            return True
+        if age <= self.lease_time: return False
+        stolen = '%s.%s.%d' % (lease, self.owner, threading.get_ident())
+        try:
+            os.rename(lease, stolen)
+        except FileNotFoundError:
+            return True
+        if self._server_time() - os.stat(stolen).st_mtime <= self.lease_time:
+            # renewed or claimed again before rename; link() fails if the item has been claimed since
+            try:
+                os.link(stolen, lease)
+            except FileExistsError:
+                pass
+            os.remove(stolen)
+            return False
+        os.remove(stolen)
+        if self.verbose: print("Taking over expired lease of %s (%ds old)" % (name, age))
+        return True
+
+    def state(self, outimg):
+        """returns the state of an item: C{'done'}, C{'failed'}, or C{None} if not finished yet
+
+        @param outimg: output file of the item
+        @rtype: str
+        """
+        name = os.path.basename(outimg)
+        if os.path.exists(self._path(name, '.done')): return 'done'
+        try:
+            with open(self._path(name, '.failed')) as f:
+                run = f.read().split(' ', 1)[0]
+        except FileNotFoundError:
+            return None
+        return 'failed' if not self.resume or run == self.run else None
+
+    def claim(self, outimg):
+        """try to claim an item, unless finished, failed or leased by another (live) worker
+
+        @param outimg: output file of the item
+        @rtype: bool
+        """
+        name = os.path.basename(outimg)
+        while True:
+            if self.state(outimg) is not None:
+                return False
+            if self._create_lease(name):
+                # the item may have been finished, and its lease removed, since checked above
+                if self.state(outimg) is not None:
+                    os.remove(self._path(name, '.lease'))
+                    return False
+                with self._lock:
+                    self._held.add(name)
+                return True
+            if not self._take_over(name):
+                return False
+
+    def holds(self, outimg):
+        """returns C{True} if this worker still holds the lease of a claimed item
+
+        @param outimg: output file of the item
+        @rtype: bool
+        """
+        name = os.path.basename(outimg)
+        with self._lock:
+            if name not in self._held: return False
+        return self._lease_owner(name) == self.owner
+
+    def scratch(self, outimg):
+        """returns the file a claimed item is composed into, with the same extension as its output file
+
+        @param outimg: output file of the item
+        @rtype: str
+        """
+        d, f = os.path.split(outimg)
+        return os.path.join(d, '.calmagick-%s-%s' % (self.owner, f))
+
+    def finish(self, outimg, failed = False):
+        """mark a claimed item as done (or failed), move its output into place and release its lease
+
+        Nothing is written if the lease has been lost, since the item now belongs to another worker.
+
+        @param outimg: output file of the item
+        @param failed: C{True} if the item failed
+        @rtype: bool
+        @return: C{False} if the lease has been lost
+        """
+        name = os.path.basename(outimg)
+        if not self.holds(outimg):
+            print("calmagick: abandoning %s, its lease has been taken over" % outimg, file=sys.stderr)
+            self.release(outimg)
+            return False
+        if not failed:
+            try:
+                os.replace(self.scratch(outimg), outimg)
+            except FileNotFoundError:
+                pass # nothing written, e.g. with --test
+        with open(self._path(name, '.failed' if failed else '.done'), 'w') as f:
+            f.write("%s %s %s\n" % (self.run, self.owner, outimg))
+        if not failed:
+            # failed marker of a previous run
+            try:
+                os.remove(self._path(name, '.failed'))
+            except OSError:
+                pass
+        self.release(outimg)
+        return True
+
+    def release(self, outimg):
+        """release the lease of a claimed item (unless taken over), so that another worker can claim it"""
+        name = os.path.basename(outimg)
+        with self._lock:
+            self._held.discard(name)
+        for f, owned in [(self.scratch(outimg), True), (self._path(name, '.lease'), self._lease_owner(name) == self.owner)]:
+            if not owned: continue
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+def compose_item(args, month, year, journal, retries = 0, spool = None):
+    """performs calendar composition for an item of the C{--range} iteration, retrying on failure
+
+    Failures other than L{lib.Abort} are retried up to I{retries} times; the item is then
+    recorded in the journal as failed, without aborting the whole run.
+
+    @param args: argument tuple for L{compose_calendar}
+    @param journal: L{Journal} object
+    @param spool: if not C{None}, L{Spool} object; the item is skipped unless claimed, and
+    abandoned if its lease is taken over by another worker
+    @rtype: bool
+    @return: C{True} on success, C{None} if the item was skipped or abandoned
+    """
+    img, outimg = args[0:2]
+    if spool is not None:
+        if not spool.claim(outimg): return None
+        args = (img, spool.scratch(outimg)) + args[2:]
+    try:
+        attempts, error = _compose_item(args, month, year, retries)
+    except BaseException:
+        # let another worker have the item
+        if spool is not None: spool.release(outimg)
+        raise
+    if spool is not None and not spool.finish(outimg, error is not None): return None
+    journal.record(img, month, year, outimg, attempts, error)
+    return error is None
+
+def _compose_item(args, month, year, retries):
+    """performs calendar composition with retries, see L{compose_item}
+
+    @rtype: (int,str)
+    @return: tuple (I{attempts,error}), where I{error} is C{None} on success
+    """
+    img = args[0]
+    for attempt in range(retries + 1):
+        try:
+            compose_calendar(*args)
+        except lib.Abort:
+            raise
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            print("calmagick: %s (%d/%d) failed, attempt %d/%d: %s" % (img, month, year, attempt + 1, retries + 1, error),
+                  file=sys.stderr)
+        else:
+            return (attempt + 1, None)
+    return (retries + 1, error)
+
+def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=None, cache=None, manifest=None):
     """performs calendar composition on a photo image
 
     @param img: photo file
@@ -503,9 +1582,34 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
     @param magick_args: [pre,in,post]-magick argument list
     @param stats: if not C{None}: tuple(I{current,total}) counting input photos
     @param cache: if cache enabled, points to the cache dictionary
+    @param manifest: if not C{None}, L{Manifest} object; the output is skipped if up to date,
+    otherwise it is recorded in the manifest once built
     """
+    if _profiler is None:
+        _build_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache, manifest)
+    else:
+        with _profiler.photo(img):
+            _build_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache, manifest)
+
+def _build_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache, manifest):
+    """performs calendar composition on a photo image, unless up to date, see L{compose_calendar}"""
+    if manifest is not None and options.test == 'none':
+        fp, entry = manifest.fingerprint(img, outimg, options, callirhoe_args, magick_args)
+        if manifest.up_to_date(outimg, fp):
+            if options.verbose:
+                if stats: print("[%d/%d]" % stats, end=' ')
+                print("Skipping up-to-date %s" % outimg)
+            return
+        _compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache)
+        manifest.update(outimg, entry)
+    else:
+        _compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache)
+
+def _compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats, cache):
+    """performs calendar composition on a photo image, see L{compose_calendar}"""
     # get image info (dimensions)
     geometry, dark = None, None
+    w, h = None, None
     if cache is not None:
         with _mutex:
             if img in cache:
@@ -514,12 +1618,28 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
             if stats: print("[%d/%d]" % stats, end=' ')
             print("Reusing image info from cache...", geometry, "DARK" if dark else "LIGHT")
 
+    akey, luma = None, None
+    if geometry is None and _analysis_cache is not None and options.placement != 'random' and options.test != 'search':
+        with _profile('lookup'):
+            akey = _analysis_cache.key(img, options, magick_args[0])
+            hit = _analysis_cache.get(akey)
+        if hit is not None:
+            (w,h), geometry, luma = hit
+            if luma is not None and options.negative > 0 and options.negative < 255:
+                dark = luma < options.negative
+            if options.verbose:
+                if stats: print("[%d/%d]" % stats, end=' ')
+                print("Reusing image info from persistent cache...", geometry)
+
     if geometry is None:
         if options.verbose:
             if stats: print("[%d/%d]" % stats, end=' ')
             print("Extracting image info...")
-        w,h = _IM_get_image_size(img, magick_args[0])
-        qresize = '%dx%d!' % ((options.quantum,)*2)
+        entropy = options.placement == 'min' or options.placement == 'max'
+        luminance = dark is None and options.negative > 0 and options.negative < 255 and options.test == 'none'
+        with _stages.stage('analysis'):
+            (w,h), pnm_entropy, lmap = _IM_analyze(img, magick_args[0], options, entropy, luminance,
+                                                   0 if magick_args[0] else options.proxy_size)
         if options.verbose:
             print("%s %dx%d %dmp R=%0.2f" % (img, w, h, int(w*h/1000000.0+0.5), float(w)/h))
 
@@ -528,65 +1648,319 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
             calratio = float(lib.atoi(tmp[0],1))/lib.atoi(tmp[1],1)
         else:
             calratio = float(options.ratio)
-        if options.placement == 'min' or options.placement == 'max':
-            geometry = _entropy_placement(img, (w,h), magick_args[0], options, calratio)
+        if entropy:
+            with _profile('fit'):
+                geometry = _entropy_placement(pnm_entropy, (w,h), options, calratio)
         else:
             geometry = _manual_placement((w,h), options, calratio)
+        if lmap is not None:
+            luma = _region_luminance(lmap, (w,h), geometry)
+        if akey is not None:
+            _analysis_cache.put(akey, (w,h), geometry, luma)
 
     if options.test != 'none':
-        if options.test == 'area':
-            subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry,
-                '-negate', outimg])
-        elif options.test == 'quant':
-            subprocess.call([_prog_im, img] + magick_args[0] + _IM_entropy_args(options.alt) +
-            [qresize, '-normalize', '-scale', '%dx%d!' % (w,h), '-region', '%dx%d+%d+%d' % geometry,
-                '-negate', outimg])
-        elif options.test == 'quantimg':
-            subprocess.call([_prog_im, img] + magick_args[0] + _IM_entropy_args(options.alt) +
-            [qresize, '-normalize', '-scale', '%dx%d!' % (w,h),
-                '-compose', 'multiply', img, '-composite', '-region', '%dx%d+%d+%d' % geometry,
-                '-negate', outimg])
-        elif options.test == 'print':
-            print(' '.join(map(str,geometry)))
-        elif options.test == 'crop':
-            subprocess.call([_prog_im, img] + magick_args[0] + ['-crop', '%dx%d+%d+%d' % geometry,
-                outimg])
+        with _stages.stage('compose'):
+            _test_placement(img, outimg, options, magick_args, (w,h), geometry)
         return
 
+    # measure luminance
+    if dark is None:
+        if options.verbose: print("Measuring luminance...", end=' ')
+        if options.negative > 0 and options.negative < 255:
+            if luma is None:
+                with _stages.stage('analysis', 'luminance'):
+                    luma = _IM_get_image_luminance(img, magick_args[0], geometry)
+            if options.verbose: print("(%s)" % luma, end=' ')
+        else:
+            luma = 255 - options.negative
+        dark = luma < options.negative
+        if options.verbose: print("DARK" if dark else "LIGHT")
+        if akey is not None and options.negative > 0 and options.negative < 255:
+            _analysis_cache.put(akey, (w,h), geometry, luma)
+        if cache is not None:
+            with _mutex:
+                cache[img] = (geometry, dark)
+
     # generate callirhoe calendar
-    if options.verbose: print("Generating calendar image (%s) ... [&]" % options.style)
     if not options.vanilla: callirhoe_args = callirhoe_args + ['--no-footer', '--border=0']
-    calimg = mktemp('.png')
-    try:
-        pcal = run_callirhoe(options.style, geometry[0:2], callirhoe_args, calimg)
-
-        if dark is None:
-            # measure luminance
-            if options.verbose: print("Measuring luminance...", end=' ')
-            if options.negative > 0 and options.negative < 255:
-                luma = _IM_get_image_luminance(img, magick_args[0], geometry)
-                if options.verbose: print("(%s)" % luma, end=' ')
-            else:
-                luma = 255 - options.negative
-            dark = luma < options.negative
-            if options.verbose: print("DARK" if dark else "LIGHT")
-            if cache is not None:
-                with _mutex:
-                    cache[img] = (geometry, dark)
-
-        pcal.wait()
-        if pcal.returncode != 0: raise RuntimeError("calmagick: calendar creation failed")
-
-        # perform final composition
-        if options.verbose: print("Composing overlay (%s)..." % outimg)
-        overlay = ['(', '-negate', calimg, ')'] if dark else [calimg]
-        subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry] +
+    if options.verbose: print("Generating calendar image (%s) ..." % options.style)
+    render = lambda: _render_calendar(options, geometry[0:2], callirhoe_args)
+    if options.no_overlay_cache:
+        calpng = render()
+    else:
+        calpng = _overlays.get((options.style, tuple(geometry[0:2]), tuple(callirhoe_args)), render)
+
+    # perform final composition
+    if options.verbose: print("Composing overlay (%s)..." % outimg)
+    with _stages.stage('compose'):
+        if options.compositor == 'cairo' and not magick_args[1]:
+            _cairo_compose(img, outimg, options, magick_args, geometry, dark, calpng)
+            return
+        overlay = ['(', '-negate', 'png:-', ')'] if dark else ['png:-']
+        subprocess.run([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry] +
             ([] if options.brightness == 0 else ['-brightness-contrast', '%d' % (-options.brightness if dark else options.brightness)]) +
             ([] if options.saturation == 100 else ['-modulate', '100,%d' % options.saturation]) + magick_args[1] +
             ['-compose', 'over'] +  overlay + ['-geometry', '+%d+%d' % geometry[2:], '-composite'] +
-            magick_args[2] + [outimg])
-    finally:
-        os.remove(calimg)
+            magick_args[2] + [outimg], input = calpng)
+
+def _render_calendar(options, size, args):
+    """generate a calendar image, either in-process or by launching callirhoe (see C{--spawn-callirhoe})
+
+    @param size: tuple (I{width},I{height}) for output calendar size (in pixels)
+    @param args: (extra) argument list to pass to callirhoe
+    @rtype: bytes
+    @return: calendar image in PNG format
+    """
+    with _stages.stage('render'):
+        if not options.spawn_callirhoe and _import_callirhoe() is not None:
+            return render_callirhoe(options.style, size, args)
+        calimg = mktemp('.png')
+        try:
+            pcal = run_callirhoe(options.style, size, args, calimg)
+            pcal.wait()
+            # exit status 2 is an option parsing error, which would fail for every photo
+            if pcal.returncode == 2: raise lib.Abort("calmagick: invalid callirhoe arguments: %s" % ' '.join(args))
+            if pcal.returncode != 0: raise RuntimeError("calmagick: calendar creation failed")
+            with open(calimg, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(calimg)
+
+class OverlayCache(object):
+    """cache of rendered calendar images, shared between worker threads
+
+    A calendar image depends only on the style, size and callirhoe arguments (including month
+    and year); whether it is negated for dark areas is decided at composition time. Only one
+    thread renders a missing image, while other threads requesting it wait for the result.
+
+    @ivar items: PNG data, in LRU order
+    @ivar max_size: maximum number of images kept
+    """
+    def __init__(self, max_size = 64):
+        self.items = OrderedDict()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending = dict()
+
+    def get(self, key, render_fn):
+        """return the calendar image for I{key}, rendering it with C{render_fn()} if missing
+
+        @rtype: bytes
+        """
+        while True:
+            with self._lock:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    return self.items[key]
+                ev = self._pending.get(key)
+                owner = ev is None
+                if owner: ev = self._pending[key] = threading.Event()
+            if not owner:
+                # if rendering fails in the owner thread, we try again
+                ev.wait()
+                continue
+            try:
+                data = render_fn()
+                with self._lock:
+                    self.items[key] = data
+                    if len(self.items) > self.max_size: self.items.popitem(last=False)
+                return data
+            finally:
+                with self._lock:
+                    del self._pending[key]
+                ev.set()
+
+_overlays = OverlayCache()
+"""L{OverlayCache} object used by L{compose_calendar}"""
+
+def _test_placement(img, outimg, options, magick_args, size, geometry):
+    """perform the placement test requested with C{--test}, instead of composing a calendar"""
+    w,h = size
+    qresize = _IM_quant_geometry(options)
+    if options.test == 'area':
+        subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry,
+            '-negate', outimg])
+    elif options.test == 'quant':
+        subprocess.call([_prog_im, img] + magick_args[0] + _IM_entropy_args(options.alt) +
+        [qresize, '-normalize', '-scale', '%dx%d!' % (w,h), '-region', '%dx%d+%d+%d' % geometry,
+            '-negate', outimg])
+    elif options.test == 'quantimg':
+        subprocess.call([_prog_im, img] + magick_args[0] + _IM_entropy_args(options.alt) +
+        [qresize, '-normalize', '-scale', '%dx%d!' % (w,h),
+            '-compose', 'multiply', img, '-composite', '-region', '%dx%d+%d+%d' % geometry,
+            '-negate', outimg])
+    elif options.test == 'print':
+        print(' '.join(map(str,geometry)))
+    elif options.test == 'search':
+        pass # results already printed by _entropy_placement()
+    elif options.test == 'crop':
+        subprocess.call([_prog_im, img] + magick_args[0] + ['-crop', '%dx%d+%d+%d' % geometry,
+            outimg])
+
+_raw_format = 'bgra' if sys.byteorder == 'little' else 'argb'
+"""IM raw pixel format matching the memory layout of C{cairo.FORMAT_ARGB32}"""
+_raw_rgb = slice(0,3) if sys.byteorder == 'little' else slice(1,4)
+"""color channels of a C{cairo.FORMAT_ARGB32} pixel, as bytes"""
+_raw_alpha = 3 if sys.byteorder == 'little' else 0
+"""alpha channel of a C{cairo.FORMAT_ARGB32} pixel, as byte"""
+
+def _modulate_saturation(c, f):
+    """scale HSL saturation of an RGB float array, like IM's C{-modulate 100,S} where M{S=100*f}
+
+    For fixed hue and lightness, every channel's distance from lightness is proportional to
+    saturation, so no explicit HSL conversion is needed.
+
+    @param c: array of shape M{(...,3)} with values in [0,1]
+    @rtype: numpy.ndarray
+    """
+    mx = c.max(axis=-1)
+    mn = c.min(axis=-1)
+    L = (mx + mn)/2
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        S = numpy.where(mx > mn, (mx - mn)/(1 - numpy.abs(2*L - 1)), 0)
+        k = numpy.where(S > 0, numpy.minimum(S*f, 1)/S, 1)
+    L = L[...,numpy.newaxis]
+    return numpy.clip(L + (c - L)*k[...,numpy.newaxis], 0, 1)
+
+def _cairo_compose(img, outimg, options, magick_args, geometry, dark, calsrc):
+    """perform the final composition in-process, using Cairo (see C{--compositor})
+
+    The photo is decoded to raw pixels by ImageMagick; the overlaid area is adjusted
+    (brightness, saturation) and the calendar is composed on top of it, which is then
+    written as PNG, or encoded by ImageMagick (applying any C{--post-magick} arguments).
+
+    @param calsrc: calendar image as PNG data
+    """
+    out = subprocess.check_output([_prog_im, img] + magick_args[0] + ['-print', '%w %h %Q\n',
+                                   '-alpha', 'opaque', '-depth', '8', _raw_format + ':-'])
+    eol = out.index(b'\n')
+    w, h, quality = list(map(int, out[0:eol].split()))
+    buf = bytearray(memoryview(out)[eol+1:])
+    del out
+    if len(buf) != w*h*4:
+        raise RuntimeError("calmagick: unexpected ImageMagick raw output")
+    px = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(h, w, 4)
+
+    gw, gh, gx, gy = geometry
+    region = px[gy:gy+gh, gx:gx+gw, _raw_rgb]
+    if options.brightness != 0 or options.saturation != 100:
+        c = region.astype(numpy.float32)/255
+        if options.brightness != 0:
+            c = numpy.clip(c + (-options.brightness if dark else options.brightness)/100.0, 0, 1)
+        if options.saturation != 100:
+            c = _modulate_saturation(c, options.saturation/100.0)
+        region[...] = (c*255 + 0.5).astype(numpy.uint8)
+
+    cal = cairo.ImageSurface.create_from_png(io.BytesIO(calsrc))
+    if dark:
+        # negate colors of premultiplied pixels: a*(1-c) = a - a*c
+        cal.flush()
+        cw, ch, cs = cal.get_width(), cal.get_height(), cal.get_stride()
+        cpx = numpy.ndarray(shape=(ch, cs//4, 4), dtype=numpy.uint8, buffer=cal.get_data())[:,0:cw]
+        cpx[..., _raw_rgb] = cpx[..., _raw_alpha:_raw_alpha+1] - cpx[..., _raw_rgb]
+        cal.mark_dirty()
+
+    surface = cairo.ImageSurface.create_for_data(buf, cairo.FORMAT_ARGB32, w, h, w*4)
+    cr = cairo.Context(surface)
+    cr.set_source_surface(cal, gx, gy)
+    cr.paint()
+    surface.flush()
+    del cr
+
+    if outimg.lower().endswith('.png') and not magick_args[2]:
+        surface.write_to_png(outimg)
+    else:
+        subprocess.run([_prog_im, '-size', '%dx%d' % (w,h), '-depth', '8', _raw_format + ':-', '-alpha', 'off'] +
+            (['-quality', str(quality)] if quality else []) + magick_args[2] + [outimg], input = buf)
+
+def _scan_files(d, parts):
+    """generator for L{iter_files}: files in directory I{d} matching pattern components I{parts}"""
+    pat, rest = parts[0], parts[1:]
+    if pat == '**':
+        for f in _scan_recursive(d, rest or ['*']): yield f
+        return
+    try:
+        entries = [e for e in os.scandir(d or os.curdir) if (pat.startswith('.') or not e.name.startswith('.'))
+                   and fnmatch.fnmatch(e.name, pat) and e.is_dir() == bool(rest)]
+    except OSError:
+        return
+    # directories are sorted as NAME/, so that the files found are in full path order, e.g. a.b/1 before a/1
+    entries.sort(key=lambda e: e.name + os.sep if rest else e.name)
+    for e in entries:
+        if rest:
+            for f in _scan_files(os.path.join(d, e.name), rest): yield f
+        else:
+            yield os.path.join(d, e.name)
+
+def _scan_recursive(d, parts):
+    """generator for L{_scan_files}: files matching pattern components I{parts} in directory I{d}
+    or any of its (non-hidden) subdirectories, i.e. matching C{**} followed by I{parts}
+
+    Files are produced in full path order: matches of I{parts} in I{d} are interleaved with
+    the matches found in each subdirectory.
+    """
+    try:
+        subdirs = sorted(e.name for e in os.scandir(d or os.curdir) if not e.name.startswith('.') and e.is_dir())
+    except OSError:
+        return
+    here = _scan_files(d, parts)
+    f = next(here, None)
+    for name in sorted(subdirs, key=lambda x: x + os.sep):
+        prefix = os.path.join(d, name) + os.sep
+        while f is not None and f < prefix:
+            yield f
+            f = next(here, None)
+        # matches of parts in d that lie within this subdirectory (only if parts has several components)
+        within = []
+        while f is not None and f.startswith(prefix):
+            within.append(f)
+            f = next(here, None)
+        sub = _scan_recursive(os.path.join(d, name), parts)
+        last = None
+        for g in heapq.merge(within, sub) if within else sub:
+            if g != last: yield g
+            last = g
+    while f is not None:
+        yield f
+        f = next(here, None)
+
+def iter_files(pattern):
+    """iterate over files matching a glob pattern, as they are found
+
+    Files are produced in the same order as C{sorted(glob.glob(pattern, recursive=True))}, but
+    directory by directory, without listing the whole tree first; C{**} matches zero or more
+    (non-hidden) directories. Unlike C{glob}, directories matching the pattern are not produced.
+
+    @rtype: iterator of str
+    """
+    if not glob.has_magic(pattern):
+        if os.path.isfile(pattern): yield pattern
+        return
+    parts = pattern.split(os.sep)
+    i = 0
+    while i < len(parts) - 1 and not glob.has_magic(parts[i]): i += 1
+    base = os.sep.join(parts[0:i])
+    if not base and pattern.startswith(os.sep): base = os.sep
+    for f in _scan_files(base, parts[i:]): yield f
+
+def reservoir_sample(iterable, k):
+    """choose I{k} random items from an iterable of unknown length, in one pass (reservoir sampling)
+
+    @param k: sample size, C{None} to keep all items
+    @rtype: ([object,...],int)
+    @return: tuple (I{sample,count}), where I{sample} is in random order and contains
+    min(I{k},I{count}) items, I{count} being the total number of items
+    """
+    sample = []
+    n = 0
+    for n, x in enumerate(iterable, 1):
+        if k is None or len(sample) < k:
+            sample.append(x)
+        else:
+            j = random.randrange(n)
+            if j < k: sample[j] = x
+    random.shuffle(sample)
+    return sample, n
 
 def parse_range(s,hint=None):
     """returns list of (I{Month,Year}) tuples for a given range
@@ -613,7 +1987,10 @@ def parse_range(s,hint=None):
 def range_worker(q,ev,i):
     """worker thread for a (I{Month,Year}) tuple
 
-    @param ev: Event used to consume remaining items in case of error
+    Items are argument tuples for L{compose_item}, which retries failed items and records them
+    in the journal.
+
+    @param ev: Event used to consume remaining items in case of an unrecoverable error
     @param q: Queue object to consume items from
     @param i: Thread number
     """
@@ -624,7 +2001,7 @@ def range_worker(q,ev,i):
         else:
             item = q.get()
             try:
-                compose_calendar(*item)
+                compose_item(*item)
             except Exception as e:
                 print("Exception in Thread-%d: %s" % (i,e.args), file=sys.stderr)
                 ev.set()
@@ -637,6 +2014,7 @@ def main_program():
     Parses options, and calls C{compose_calendar()} the appropriate number of times,
     possibly by multiple threads (if requested by user)
     """
+    global _analysis_cache, _stages, _profiler
     parser = get_parser()
 
     magick_args = parse_magick_args()
@@ -652,16 +2030,55 @@ def main_program():
         # this way we get an exception if outdir exists and is a normal file
         os.mkdir(options.outdir)
 
+    if options.cache:
+        try:
+            _analysis_cache = AnalysisCache(os.path.expanduser(options.cache))
+        except sqlite3.Error as e:
+            raise lib.Abort("calmagick: cannot open cache '%s': %s" % (options.cache, e))
+
+    manifest = Manifest(options.outdir) if options.incremental else None
+    failure = None
+
+    if options.profile:
+        try:
+            _profiler = Profiler(options.profile)
+        except IOError as e:
+            raise lib.Abort("calmagick: cannot open profile '%s': %s" % (options.profile, e))
+
     if options.range:
-        flist = sorted(glob.glob(args[0]))
-        mrange = parse_range(options.range,hint=len(flist))
-        if options.verbose: print("Composing %d photos..." % len(mrange))
+        photos = iter_files(args[0])
+        mrange = parse_range(options.range)
+        # with a known month span, only the photos actually used are enumerated (unless sampling)
         if options.sample is not None:
-            flist = random.sample(flist, options.sample if options.sample else min(len(mrange),len(flist)))
+            flist, total = reservoir_sample(photos, options.sample if options.sample else (len(mrange) or None))
+        else:
+            flist = list(itertools.islice(photos, len(mrange)) if mrange else photos)
+            total = len(flist)
+        if not mrange: mrange = parse_range(options.range,hint=total)
+        if options.verbose: print("Composing %d photos..." % len(mrange))
         nf = len(flist)
         if nf > 0:
+            spool = None
+            if options.spool:
+                try:
+                    spool = Spool(options.spool, options.lease_time, options.verbose, options.resume)
+                except OSError as e:
+                    raise lib.Abort("calmagick: cannot use spool directory '%s': %s" % (options.spool, e))
+            # workers sharing a spool keep a journal each, the spool markers tell what is left to resume
+            jfile = options.journal or os.path.join(options.outdir, '.calmagick-journal%s.jsonl' % (
+                '.' + spool.owner if spool else ''))
+            try:
+                journal = Journal(jfile, options.resume)
+            except (IOError, OSError) as e:
+                raise lib.Abort("calmagick: cannot open journal '%s': %s" % (jfile, e))
             if len(mrange) > nf and options.prefix == 'no?': options.prefix = 'yes'
             if options.jobs > 1:
+                _stages = StageLimiter(dict(analysis=options.analysis_jobs, render=options.render_jobs,
+                                            compose=options.compose_jobs), options.verbose)
+                if 'MAGICK_THREAD_LIMIT' not in os.environ:
+                    im_tasks = min(options.jobs, options.analysis_jobs + options.compose_jobs)
+                    os.environ['MAGICK_THREAD_LIMIT'] = str(max(1, (os.cpu_count() or 1) // im_tasks))
+                    if options.verbose: print("Using MAGICK_THREAD_LIMIT=%s" % os.environ['MAGICK_THREAD_LIMIT'])
                 q = queue.Queue()
                 ev = threading.Event()
                 for i in range(options.jobs):
@@ -670,23 +2087,61 @@ def main_program():
                      t.start()
 
             cache = get_cache(nf, len(mrange));
+            skipped = 0
+            items = []
             for i in range(len(mrange)):
                 img = flist[i % nf]
                 m,y = mrange[i]
                 prefix = '' if options.prefix.startswith('no') else '%04d-%02d_' % (y,m)
                 outimg = get_outfile(img,options.outdir,prefix,options.format)
-                args = (img, outimg, options, [str(m), str(y)] + argv2, magick_args,
-                        (i+1,len(mrange)), cache)
-                if options.jobs > 1: q.put(args)
-                else: compose_calendar(*args)
-
-            if options.jobs > 1: q.join()
+                if options.resume and journal.is_done(img, m, y, outimg):
+                    skipped += 1
+                    continue
+                args = ((img, outimg, options, [str(m), str(y)] + argv2, magick_args,
+                        (i+1,len(mrange)), cache, manifest), m, y, journal, options.retries, spool)
+                items.append(args)
+            if skipped and options.verbose: print("Resumed: skipped %d photos already composed" % skipped)
+
+            pending = items
+            while pending:
+                for args in pending:
+                    if options.jobs > 1: q.put(args)
+                    else: compose_item(*args)
+                if options.jobs > 1: q.join()
+                if spool is None or (options.jobs > 1 and ev.is_set()): break
+                # photos leased by other workers: wait until finished, or take them over if their leases expire
+                pending = [args for args in pending if spool.state(args[0][1]) is None]
+                if pending:
+                    if options.verbose: print("Waiting for %d photos leased by other workers..." % len(pending))
+                    time.sleep(options.lease_time/3.0)
+
+            if options.jobs > 1 and options.verbose: print("Stages:", _stages.report())
+            journal.close()
+            if spool is not None: spool.close()
+            failed = list(journal.failed)
+            if spool is not None:
+                mine = set(f[3] for f in failed)
+                failed += [(a[0][0], a[1], a[2], a[0][1], "failed by another worker") for a in items
+                           if a[0][1] not in mine and spool.state(a[0][1]) == 'failed']
+            if options.jobs > 1 and ev.is_set():
+                failure = "calmagick: run aborted; use --resume to compose the remaining photos"
+            elif failed:
+                for img, m, y, outimg, error in failed:
+                    print("calmagick: failed %s (%d/%d): %s" % (img, m, y, error), file=sys.stderr)
+                failure = "calmagick: %d of %d photos failed; use --resume to retry them" % (
+                    len(failed), len(mrange) - skipped)
     else:
         img = args[0]
         if not os.path.isfile(img):
             raise lib.Abort("calmagick: input image '%s' does not exist" % img)
         outimg = get_outfile(img,options.outdir,'',options.format,options.outfile)
-        compose_calendar(img, outimg, options, argv2, magick_args)
+        compose_calendar(img, outimg, options, argv2, magick_args, manifest=manifest)
+
+    if manifest is not None: manifest.close()
+    if _profiler is not None:
+        _profiler.close()
+        print(_profiler.summary(), file=sys.stderr)
+    if failure: raise lib.Abort(failure)
 
 if __name__ == '__main__':
     try:
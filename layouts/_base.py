@@ -18,6 +18,8 @@
 """base layout module -- others may inherit from this one"""
 
 import optparse
+import multiprocessing
+import random
 from lib.xcairo import *
 from lib.geom import *
 from math import floor, ceil, sqrt
@@ -70,6 +72,8 @@ def get_parser(layout_name):
                       help="swap month colors for even/odd years")
     parser.add_option("--fractal", action="store_true", default=False,
                       help="2x2 fractal layout; overrides rows=2, cols=2, z-order=increasing")
+    parser.add_option("--jobs", type="int", default=1,
+                      help="render pages in parallel using JOBS processes (PNG output only) [%default]")
     return parser
 
 
@@ -194,7 +198,11 @@ class CalendarRenderer(object):
     @ivar holiday_provider: L{HolidayProvider} object
     @ivar version_string: callirhoe version string
     @ivar options: parser options object
+    @ivar page_sink: if not C{None}, list receiving PNG pages as C{bytes} instead of writing
+    them to L{Outfile}, see L{PageWriter.sink}
     """
+    page_sink = None
+
     def __init__(self, Outfile, Year, Month, MonthSpan, Theme, holiday_provider, version_string, options):
         self.Outfile = Outfile
         self.Year = Year
@@ -232,6 +240,35 @@ class CalendarRenderer(object):
 
 #rows = 0
 #cols = 0
+    def _draw_page(self, cr, grid, p, z_order, Rc, footer_font):
+        """render the months of a page, along with the page footer
+
+        @param cr: cairo context
+        @param grid: month grid layout (L{GLayout})
+        @param p: list of I{(month,year)} tuples to be placed on the page, in grid order
+        @param z_order: either `increasing' or `decreasing'
+        @param Rc: footer line rect, or C{None} if no footer should be drawn
+        @param footer_font: footer font name
+        """
+        num_placed = 0
+        yy = [p[0][1]]
+        if z_order == "decreasing": p = list(reversed(p))
+        for (m,y) in p:
+            k = len(p) - num_placed - 1 if z_order == "decreasing" else num_placed
+            self._draw_month(cr, grid.item_seq(k, self.options.grid_order == "column"),
+                       month=m, year=y)
+            num_placed += 1
+            if y > yy[-1]:
+                yy.append(y)
+        if Rc is None: return
+        if not self.options.month_with_year:
+            year_str = str(yy[0]) if yy[0] == yy[-1] else "%s – %s" % (yy[0],yy[-1])
+            draw_str(cr, text = year_str, rect = Rc, stroke_rgba = (0,0,0,0.5), scaling = -1,
+                     align = (0,0), font = (footer_font,0,0))
+        draw_str(cr, text = "rendered by Callirhoe ver. %s" % self.version_string,
+                 rect=Rc, stroke_rgba=(0, 0, 0, 0.5), scaling=-1, align=(1, 0),
+                 font=(footer_font, 1, 0))
+
     def render(self):
         """main calendar rendering routine"""
         S,G,L = self.Theme
@@ -252,8 +289,9 @@ class CalendarRenderer(object):
             S.month.color_map_bg = (S.month.color_map_bg[1], S.month.color_map_bg[0])
             S.month.color_map_fg = (S.month.color_map_fg[1], S.month.color_map_fg[0])
 
+        page_args = (self.Outfile, G.pagespec, not self.options.opaque, G.landscape, G.border)
         try:
-            page = PageWriter(self.Outfile, G.pagespec, not self.options.opaque, G.landscape, G.border)
+            page = PageWriter(*page_args, sink = self.page_sink)
         except InvalidFormat as e:
             print("invalid output format", e.args[0], file=sys.stderr)
             sys.exit(1)
@@ -308,29 +346,31 @@ class CalendarRenderer(object):
                 z_order = "decreasing"
             else:
                 z_order = "increasing"
+        if not self.options.no_footer:
+            footer_font = extract_font_name(S.month.font)
+        else:
+            Rc = footer_font = None
+
+        jobs = self.options.jobs
+        if (jobs > 1 and num_pages > 1 and page.format == PageWriter.PNG and not self.options.fractal
+            and self.page_sink is None):
+            global _pool_job
+            _pool_job = (self, page_args, grid, page_layout, z_order, Rc, footer_font)
+            pool = multiprocessing.get_context('fork').Pool(min(jobs, num_pages))
+            try:
+                pool.map(_render_page, range(num_pages))
+            finally:
+                pool.close()
+                pool.join()
+                _pool_job = None
+            return
+
         total_placed = 0
         for p in page_layout:  # [[(month,year),...],...]
-            num_placed = 0
-            yy = [p[0][1]]
-            if z_order == "decreasing": p.reverse()
-            for (m,y) in p:
-                k = len(p) - num_placed - 1 if z_order == "decreasing" else num_placed
-                self._draw_month(page.cr, grid.item_seq(k, self.options.grid_order == "column"),
-                           month=m, year=y)
-                num_placed += 1
-                total_placed += 1
-                if y > yy[-1]:
-                    yy.append(y)
             # TODO: use full year range in fractal mode
             valid_page = not self.options.fractal or num_pages_written == 0
-            if not self.options.month_with_year and not self.options.no_footer and valid_page:
-                year_str = str(yy[0]) if yy[0] == yy[-1] else "%s – %s" % (yy[0],yy[-1])
-                draw_str(page.cr, text = year_str, rect = Rc, stroke_rgba = (0,0,0,0.5), scaling = -1,
-                         align = (0,0), font = (extract_font_name(S.month.font),0,0))
-            if not self.options.no_footer and valid_page:
-                draw_str(page.cr, text = "rendered by Callirhoe ver. %s" % self.version_string,
-                         rect=Rc, stroke_rgba=(0, 0, 0, 0.5), scaling=-1, align=(1, 0),
-                         font=(extract_font_name(S.month.font), 1, 0))
+            self._draw_page(page.cr, grid, p, z_order, Rc if valid_page else None, footer_font)
+            total_placed += len(p)
             num_pages_written += 1
             if self.options.fractal:
                 if total_placed < self.MonthSpan-1:
@@ -345,3 +385,18 @@ class CalendarRenderer(object):
                 page.end_page()
                 if num_pages_written < num_pages:
                     page.new_page()
+
+_pool_job = None
+"""rendering state shared with forked page rendering processes, see L{_render_page}"""
+
+def _render_page(k):
+    """render page I{k} into its own L{PageWriter}, in a forked worker process
+
+    Used by L{CalendarRenderer.render} when more than one job is requested for PNG output.
+    """
+    renderer, page_args, grid, page_layout, z_order, Rc, footer_font = _pool_job
+    random.seed() # do not repeat the parent's sloppy boxes in every worker
+    page = PageWriter(*page_args)
+    page.curpage = k + 1
+    renderer._draw_page(page.cr, grid, page_layout[k], z_order, Rc, footer_font)
+    page.end_page()
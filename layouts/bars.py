@@ -43,6 +43,7 @@ class CalendarRenderer(_base.CalendarRenderer):
             mmeasure += 'A'*(len(str(year))+1)
 
         rows = 31 if G.month.symmetric else span 
+        mtable = self.holiday_provider.month_table(year, month)
         grid = VLayout(rect_from_origin(rect), 32) # title bar always symmetric
         dom_grid = VLayout(grid.item_span(31,1), rows)
 
@@ -56,7 +57,7 @@ class CalendarRenderer(_base.CalendarRenderer):
         for dom in range(1,rows+1):
             R = dom_grid.item(dom-1)
             if dom <= span:
-                holiday_tuple = self.holiday_provider(year, month, dom, day)
+                holiday_tuple = mtable[dom-1]
                 day_style = holiday_tuple[2]
                 dcell = _base.DayCell(day = (day, date(year, month, dom)), header = holiday_tuple[0], footer = holiday_tuple[1],
                                       theme = (day_style, G.dom, L), show_day_name = True, options = self.options)
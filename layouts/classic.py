@@ -34,6 +34,9 @@ parser.add_option("--lw-inner-padding", type="float", default=1.5,
                   help="inner padding for month box in lightweight mode")
 parser.add_option("--iso-week", action="store_true", default=False,
                   help="show ISO week number (starts on Monday)")
+parser.add_option("--no-tile-cache", action="store_true", default=False,
+                  help="draw every month from scratch, instead of replaying identical months "
+                  "(same weekday offset, length, holidays and colors) drawn before")
 
 
 def _weekrows_of_month(year, month):
@@ -48,14 +51,95 @@ def _weekrows_of_month(year, month):
     return 5
 
 class CalendarRenderer(_base.CalendarRenderer):
-    """classic tiles layout class"""
-    def _draw_month(self, cr, rect, month, year):
-        S,G,L = self.Theme
-        make_sloppy_rect(cr, rect, G.month.sloppy_dx, G.month.sloppy_dy, G.month.sloppy_rot)
+    """classic tiles layout class
+
+    @ivar tiles: L{TileCache} of already drawn months, see L{_month_key}
+    """
+    def __init__(self, *args, **kwargs):
+        super(CalendarRenderer, self).__init__(*args, **kwargs)
+        self.tiles = TileCache()
 
+    def _month_cells(self, month, year):
+        """returns the day cells of a month in row-major order
+
+        Each cell is either a tuple I{(day_style,)} for an empty cell, or a tuple
+        I{(day_style,header,footer,cell_date)} for a day cell to be drawn.
+
+        @rtype: [tuple,...]
+        """
+        S,G,L = self.Theme
         day, span = calendar.monthrange(year, month)
         weekrows = 6 if G.month.symmetric else _weekrows_of_month(year, month)
         dom = -day + 1;
+        mtable = self.holiday_provider.month_table(year, month)
+        cells = []
+        for row in range(weekrows):
+            for col in range(7):
+                is_normal = dom > 0 and dom <= span
+                if is_normal or self.options.phantom_days:
+                    real_year, real_month, real_dom = year, month, dom
+
+                    # handle phantom days
+                    if dom < 1:
+                        real_month -= 1
+                        if real_month < 1:
+                            real_month = 12
+                            real_year -= 1
+                        real_dom += calendar.monthrange(real_year, real_month)[1]
+                    elif dom > span:
+                        real_month += 1
+                        if real_month > 12:
+                            real_month = 1
+                            real_year += 1
+                        real_dom -= span
+
+                    if is_normal:
+                        holiday_tuple = mtable[dom-1]
+                        day_style = holiday_tuple[2]
+                    else:
+                        holiday_tuple = self.holiday_provider.month_table(real_year, real_month)[real_dom-1]
+                        day_style = S.dom_weekend_phantom if col >= 5 else S.dom_phantom
+                    cells.append((day_style, holiday_tuple[0], holiday_tuple[1], date(real_year, real_month, real_dom)))
+                else:
+                    cells.append((S.dom_weekend if col >= 5 else S.dom,))
+                dom += 1
+        return cells
+
+    def _month_key(self, rect, month, year, cells):
+        """returns the render signature of a month: months with equal signatures are drawn identically
+
+        @rtype: tuple
+        """
+        S,G,L = self.Theme
+        title_str = L.month_name[month]
+        if self.options.month_with_year: title_str += ' ' + str(year)
+        cell_keys = []
+        for cell in cells:
+            if len(cell) == 1:
+                cell_keys.append(cell)
+            else:
+                day_style, header, footer, cell_date = cell
+                week = cell_date.isocalendar()[1] if self.options.iso_week else None
+                cell_keys.append((day_style, header, footer, cell_date.day, week))
+        return (rect[2], rect[3], title_str, S.month.color_map_bg[year%2][month],
+                S.month.color_map_fg[year%2][month], tuple(cell_keys))
+
+    def _draw_month(self, cr, rect, month, year):
+        S,G,L = self.Theme
+        make_sloppy_rect(cr, rect, G.month.sloppy_dx, G.month.sloppy_dy, G.month.sloppy_rot)
+        cells = self._month_cells(month, year)
+        sloppy = G.month.sloppy_dx != 0 or G.month.sloppy_dy != 0 or G.month.sloppy_rot != 0
+        if sloppy or self.options.no_tile_cache:
+            self._draw_month_tile(cr, rect, month, year, cells)
+        else:
+            self.tiles.draw(cr, self._month_key(rect, month, year, cells), rect_from_origin(rect),
+                            lambda tcr: self._draw_month_tile(tcr, rect, month, year, cells))
+        cr.restore()
+
+    def _draw_month_tile(self, cr, rect, month, year, cells):
+        """draw the month contents, with the month box placed at the origin"""
+        S,G,L = self.Theme
+        weekrows = len(cells) // 7
         wmeasure = 'A'*max(list(map(len,L.day_name)))
         mmeasure = 'A'*max(list(map(len,L.month_name)))
         if self.options.month_with_year:
@@ -96,39 +180,18 @@ class CalendarRenderer(_base.CalendarRenderer):
         for row in range(weekrows):
             for col in range(7):
                 R = dom_grid.item(row, col)
-                is_normal = dom > 0 and dom <= span
-                if is_normal or self.options.phantom_days:
-                    real_year, real_month, real_dom = year, month, dom
-
-                    # handle phantom days
-                    if dom < 1:
-                        real_month -= 1
-                        if real_month < 1:
-                            real_month = 12
-                            real_year -= 1
-                        real_dom += calendar.monthrange(real_year, real_month)[1]
-                    elif dom > span:
-                        real_month += 1
-                        if real_month > 12:
-                            real_month = 1
-                            real_year += 1
-                        real_dom -= span
-
-                    holiday_tuple = self.holiday_provider(real_year, real_month, real_dom, col)
-                    if is_normal:
-                        day_style = holiday_tuple[2]
-                    else:
-                        day_style = S.dom_weekend_phantom if col >= 5 else S.dom_phantom
-                    dcell = _base.DayCell(day = (col, date(real_year, real_month, real_dom)), header = holiday_tuple[0], footer = holiday_tuple[1],
+                cell = cells[row*7 + col]
+                if len(cell) > 1:
+                    day_style, header, footer, cell_date = cell
+                    dcell = _base.DayCell(day = (col, cell_date), header = header, footer = footer,
                                           theme = (day_style, G.dom, L), show_day_name = False, 
                                           options = self.options )
                     dcell.draw(cr, R)
                 else:
-                    day_style = S.dom_weekend if col >= 5 else S.dom
+                    day_style = cell[0]
                     draw_box(cr, rect = R, stroke_rgba = day_style.frame, fill_rgba = day_style.bg,
                              stroke_width = mm_to_dots(day_style.frame_thickness),
                              lightweight = self.options.lightweight)
-                dom += 1
                 
         # draw month title (name)
         mcolor = S.month.color_map_bg[year%2][month]
@@ -149,5 +212,4 @@ class CalendarRenderer(_base.CalendarRenderer):
         if self.options.month_with_year: title_str += ' ' + str(year)
         draw_str(cr, text = title_str, rect = R_text, scaling = -1, stroke_rgba = mcolor_fg,
                  align = (2,0), font = S.month.font, measure = mmeasure, shadow = mshad)
-        cr.restore()
 
@@ -70,6 +70,8 @@ def get_parser(layout_name):
                       help="swap month colors for even/odd years")
     parser.add_option("--fractal", action="store_true", default=False,
                       help=optparse.SUPPRESS_HELP)
+    parser.add_option("--jobs", type="int", default=1,
+                      help="render pages in parallel using JOBS processes (PNG output only) [%default]")
     return parser
 
 parser = get_parser(__name__)
@@ -143,6 +145,7 @@ class CalendarRenderer(_base.CalendarRenderer):
         mmeasure = 'A'*max(list(map(len,L.month_name)))
 
         rows = 31 if G.month.symmetric else span
+        mtable = self.holiday_provider.month_table(year, month)
         grid = VLayout(rect_from_origin(rect), 32) # title bar always symmetric
         dom_grid = VLayout(grid.item_span(31,1), rows)
 
@@ -159,7 +162,7 @@ class CalendarRenderer(_base.CalendarRenderer):
         # draw day cells
         for dom in range(1,span+1):
             R = dom_grid.item(dom-1)
-            holiday_tuple = self.holiday_provider(year, month, dom, day)
+            holiday_tuple = mtable[dom-1]
             day_style = holiday_tuple[2]
             header = holiday_tuple[0]
             footer = holiday_tuple[1]
@@ -22,11 +22,23 @@
 #                                         #
 # *****************************************
 
+import os
+import mmap
+import struct
 from datetime import date, timedelta
+from calendar import monthrange
 
-def _get_orthodox_easter(year):
-    """compute date of orthodox easter
-    @rtype: datetime.date
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _orthodox_easter_offset(year):
+    """compute date of orthodox easter, as days after March 1st
+
+    Only integer arithmetic is used, so I{year} may also be a NumPy array of years.
+
+    @rtype: int
     """
     y1, y2, y3 = year % 4 , year % 7, year % 19
     a = 19*y3 + 15
@@ -34,14 +46,14 @@ def _get_orthodox_easter(year):
     b = 2*y1 + 4*y2 + 6*(y4 + 1)
     y5 = b % 7
     r = 1 + 3 + y4 + y5
-    return date(year, 3, 31) + timedelta(r)
+    return 30 + r   # March 31st + r days
 #    res = date(year, 5, r - 30) if r > 30 else date(year, 4, r)
 #    return res
 
-def _get_catholic_easter(year):
-    """compute date of catholic easter
+def _catholic_easter_offset(year):
+    """compute date of catholic easter, as days after March 1st (vectorizable like L{_orthodox_easter_offset})
 
-    @rtype: datetime.date
+    @rtype: int
     """
     a, b, c = year % 19, year // 100, year % 100
     d, e = divmod(b,4)
@@ -51,8 +63,85 @@ def _get_catholic_easter(year):
     i, k = divmod(c,4)
     l = (32 + 2*e + 2*i - h - k) % 7
     m = (a + 11*h + 22*l) // 451
-    emonth,edate = divmod(h + l - 7*m + 114,31)
-    return date(year, emonth, edate+1)
+    # easter month, date = divmod(h + l - 7*m + 114, 31), with month 3 or 4
+    return h + l - 7*m + 114 - 3*31
+
+def _get_orthodox_easter(year):
+    """compute date of orthodox easter
+    @rtype: datetime.date
+    """
+    return date(year, 3, 1) + timedelta(_orthodox_easter_offset(year))
+
+def _get_catholic_easter(year):
+    """compute date of catholic easter
+
+    @rtype: datetime.date
+    """
+    return date(year, 3, 1) + timedelta(_catholic_easter_offset(year))
+
+def _get_george(year, orthodox_easter):
+    """compute St George's day, moved after orthodox easter if it would occur before it
+
+    @rtype: datetime.date
+    """
+    dt = date(year,4,23)
+    if orthodox_easter >= dt: dt = orthodox_easter + timedelta(1)  # >= or > ??
+    return dt
+
+class EasterTable(object):
+    """precomputed easter-dependent dates for a window of years
+
+    The easter offsets of all years in the window are computed at once, vectorized
+    with NumPy when available. Years outside the window are computed on demand and
+    remembered.
+
+    @ivar first_year: first year of the window
+    @ivar last_year: last year of the window
+    @ivar dates: dict of I{(orthodox_easter,catholic_easter,george)} date tuples, indexed by year
+    """
+    def __init__(self, first_year = 1900, last_year = 2199):
+        self.first_year = first_year
+        self.last_year = last_year
+        if numpy is not None:
+            years = numpy.arange(first_year, last_year + 1)
+            oe = _orthodox_easter_offset(years).tolist()
+            ce = _catholic_easter_offset(years).tolist()
+        else:
+            years = range(first_year, last_year + 1)
+            oe = [_orthodox_easter_offset(y) for y in years]
+            ce = [_catholic_easter_offset(y) for y in years]
+        self.dates = dict()
+        for k in range(len(oe)):
+            y = first_year + k
+            march1 = date(y,3,1)
+            edt = march1 + timedelta(oe[k])
+            self.dates[y] = (edt, march1 + timedelta(ce[k]), _get_george(y, edt))
+
+    def __call__(self, year):
+        """return I{(orthodox_easter,catholic_easter,george)} date tuple for I{year}
+
+        @rtype: (datetime.date,datetime.date,datetime.date)
+        """
+        if year not in self.dates:
+            edt = _get_orthodox_easter(year)
+            self.dates[year] = (edt, _get_catholic_easter(year), _get_george(year, edt))
+        return self.dates[year]
+
+_easter_table = None
+"""process-wide L{EasterTable} shared by all L{HolidayProvider} objects"""
+
+def set_easter_window(first_year, last_year):
+    """(re)build the process-wide easter table for years I{first_year} to I{last_year}"""
+    global _easter_table
+    _easter_table = EasterTable(first_year, last_year)
+
+def get_easter_table():
+    """return the process-wide easter table, building it with the default window if needed
+
+    @rtype: EasterTable
+    """
+    if _easter_table is None: set_easter_window(1900, 2199)
+    return _easter_table
 
 def _strip_empty(sl):
     """strip empty strings from list I{sl}
@@ -164,6 +253,180 @@ def _decode_date_str(ddef):
         return (int(ddef[:4]),int(ddef[4:6]),int(ddef[-2:]))
     raise ValueError("invalid date definition '%s'" % ddef)
 
+def _parse_day_record(fields):
+    """return tuple (etype,ddef,footer,header,flags)
+
+       @rtype: (char,type(ddef),str,str,int)
+       @note: I{ddef} is one of the following:
+            - None
+            - int
+            - ((y,m,d),)
+            - ((y,m,d),(y,m,d))
+    """
+    if len(fields) != 5:
+        raise ValueError("Too many fields: " + str(fields))
+    for i in range(len(fields)):
+        if len(fields[i]) == 0: fields[i] = None
+    if fields[0] == 'd':
+        if fields[1]:
+            if '*' in fields[1]:
+                if fields[0] != 'd':
+                    raise ValueError("multi-day events not allowed with event type '%s'" % fields[0])
+                dstr,spanstr = fields[1].split('*')
+                if len(dstr) != 8:
+                    raise ValueError("multi-day events allowed only with full date, not '%s'" % dstr)
+                span = int(spanstr)
+                y,m,d = _decode_date_str(dstr)
+                dt1 = date(y,m,d)
+                dt2 = dt1 + timedelta(span-1)
+                res = ((y,m,d),(dt2.year,dt2.month,dt2.day))
+            elif '-' in fields[1]:
+                if fields[0] != 'd':
+                    raise ValueError("multi-day events not allowed with event type '%s'" % fields[0])
+                dstr,dstr2 = fields[1].split('-')
+                if len(dstr) != 8:
+                    raise ValueError("multi-day events allowed only with full date, not '%s'" % dstr)
+                y,m,d = _decode_date_str(dstr)
+                y2,m2,d2 = _decode_date_str(dstr2)
+                res = ((y,m,d),(y2,m2,d2))
+            else:
+                y,m,d = _decode_date_str(fields[1])
+                if len(fields[1]) == 8:
+                    res = ((y,m,d),(y,m,d))
+                else:
+                    res = ((y,m,d),)
+        else:
+            res = None
+    else:
+        res = int(fields[1])
+    return (fields[0],res,fields[2],fields[3],fields[4])
+
+def _read_text_records(filename):
+    """parse a holiday text file, yielding one (etype,ddef,footer,header,flags) tuple per record
+
+    @rtype: iterator
+    @see: L{_parse_day_record}, L{HolidayProvider.load_holiday_file}
+    """
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            if line[0] == '#': continue
+            yield _parse_day_record(line.split('|'))
+
+_CDB_MAGIC = b'CHDB'
+_CDB_VERSION = 1
+_CDB_HEADER = struct.Struct('<4sHqqII')
+"""compiled file header: magic, version, source mtime (ns), source size, string count, record count"""
+_CDB_STRING = struct.Struct('<II')
+"""compiled string table entry: offset and length in the string blob"""
+_CDB_RECORD = struct.Struct('<BHBBHBBiiii')
+"""compiled rule record: type, y1, m1, d1, y2, m2, d2, easter offset, footer, header and flags string indices"""
+_CDB_TYPES = ['d', 'd', 'oe', 'ge', 'ce']
+"""compiled record type codes: 0 = single date, 1 = date range, 2 = orthodox easter, 3 = St George, 4 = catholic easter"""
+
+def compiled_name(filename):
+    """return the file name of the compiled form of holiday file I{filename}
+
+    @rtype: str
+    """
+    return filename + 'c'
+
+def compile_holiday_file(filename, outfile = None):
+    """compile a holiday text file into a binary, indexed form that can be loaded through C{mmap}
+
+    The compiled file holds a string table and one fixed-size record per rule, with dates
+    and easter offsets already decoded. It also records the modification time and size of
+    I{filename}, so that a stale compiled file is ignored by L{HolidayProvider.load_holiday_file}.
+
+    @param filename: holiday text file
+    @param outfile: output file, defaults to L{compiled_name}(I{filename})
+    @rtype: str
+    @return: output file name
+    """
+    if outfile is None: outfile = compiled_name(filename)
+    st = os.stat(filename)
+    strings = dict()
+    def sid(x):
+        if x is None: return -1
+        if x not in strings: strings[x] = len(strings)
+        return strings[x]
+    records = []
+    for etype,ddef,footer,header,flags in _read_text_records(filename):
+        y1 = m1 = d1 = y2 = m2 = d2 = offset = 0
+        if etype == 'd':
+            code = len(ddef) - 1
+            y1,m1,d1 = ddef[0]
+            if code: y2,m2,d2 = ddef[1]
+        else:
+            code = _CDB_TYPES.index(etype)
+            offset = ddef
+        records.append(_CDB_RECORD.pack(code, y1, m1, d1, y2, m2, d2, offset,
+                                        sid(footer), sid(header), sid(flags)))
+    blobs = [x.encode('utf-8') for x in sorted(strings, key=strings.get)]
+    index = []
+    pos = 0
+    for x in blobs:
+        index.append(_CDB_STRING.pack(pos, len(x)))
+        pos += len(x)
+    tmpfile = outfile + '.tmp%d' % os.getpid()
+    with open(tmpfile, 'wb') as f:
+        f.write(_CDB_HEADER.pack(_CDB_MAGIC, _CDB_VERSION, st.st_mtime_ns, st.st_size, len(blobs), len(records)))
+        f.write(b''.join(index))
+        f.write(b''.join(records))
+        f.write(b''.join(blobs))
+    os.replace(tmpfile, outfile)
+    return outfile
+
+def _read_compiled_records(filename, cfilename):
+    """read the records of a compiled holiday file through C{mmap}
+
+    @return: list of (etype,ddef,footer,header,flags) tuples, as L{_read_text_records} yields,
+    or C{None} if I{cfilename} does not exist, is stale with respect to I{filename}, or is corrupt
+    @rtype: [tuple,...]
+    """
+    try:
+        st = os.stat(filename)
+        f = open(cfilename, 'rb')
+    except OSError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < _CDB_HEADER.size: return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                return _decode_compiled(mm, st)
+            except (struct.error, IndexError, UnicodeDecodeError):
+                # truncated or corrupt file, treated as stale
+                return None
+
+def _decode_compiled(mm, st):
+    """decode the records of a compiled holiday file mapped in I{mm}, see L{_read_compiled_records}
+
+    @param st: C{os.stat()} result of the holiday text file, used for detecting stale files
+    @rtype: [tuple,...]
+    """
+    magic,version,mtime,size,nstr,nrec = _CDB_HEADER.unpack_from(mm)
+    if magic != _CDB_MAGIC or version != _CDB_VERSION: return None
+    if mtime != st.st_mtime_ns or size != st.st_size: return None
+    pos = _CDB_HEADER.size
+    base = pos + nstr*_CDB_STRING.size + nrec*_CDB_RECORD.size
+    if base > len(mm): return None
+    strings = []
+    for off,length in _CDB_STRING.iter_unpack(mm[pos:pos + nstr*_CDB_STRING.size]):
+        if base + off + length > len(mm): return None
+        strings.append(mm[base+off:base+off+length].decode('utf-8'))
+    pos += nstr*_CDB_STRING.size
+    res = []
+    for code,y1,m1,d1,y2,m2,d2,offset,footer,header,flags in _CDB_RECORD.iter_unpack(mm[pos:base]):
+        if code == 0: ddef = ((y1,m1,d1),)
+        elif code == 1: ddef = ((y1,m1,d1),(y2,m2,d2))
+        else: ddef = offset
+        res.append((_CDB_TYPES[code], ddef,
+                    strings[footer] if footer >= 0 else None,
+                    strings[header] if header >= 0 else None,
+                    strings[flags] if flags >= 0 else None))
+    return res
+
 class HolidayProvider(object):
     """class holding the holidays throught the year(s)
 
@@ -171,7 +434,13 @@ class HolidayProvider(object):
     each dict entry is actually a list of L{Holiday} objects. This is also true for the other
     instance variables: L{monthly}, L{fixed}, L{orth_easter}, L{george}, L{cath_easter}.
     @ivar monthly: event occuring monthly, indexed by int I{day}
-    @ivar fixed: fixed date events, indexed by a C{date()} object
+    @ivar fixed: fixed date events, bucketed per year: C{fixed[year]} is a dict indexed by a C{date()} object;
+    list items are C{(seq,holiday)} tuples, where I{seq} is the rule sequence number (see L{nrules})
+    @ivar ranges: multi-day fixed date events, bucketed per year: C{ranges[year]} is a list of
+    C{(seq,date1,date2,hols)} tuples, one for each range overlapping that year, where I{hols} is the 4-tuple
+    returned by L{_multi_holiday_tuple}; ranges are expanded into days only when a year is requested
+    @ivar nrules: number of fixed date rules loaded so far, used for merging L{fixed} and L{ranges}
+    events of the same day in file order
     @ivar orth_easter: dict of events relative to the orthodox easter Sunday, indexed by
     an integer days offset
     @ivar george: events occuring on St George's day (orthodox calendar special computation)
@@ -182,6 +451,8 @@ class HolidayProvider(object):
     dict C{cache}, indexed by a C{date()} object
     @ivar ycache: set holding cached years; each new year requested, triggers a cache-fill
     operation
+    @ivar mcache: dict of per-month (header,footer,day_style) tables, indexed by tuple I{(year,month)},
+    see L{month_table}
     """
     def __init__(self, s_normal, s_weekend, s_holiday, s_weekend_holiday, s_multi, s_weekend_multi, multiday_markers=True):
         """initialize a C{HolidayProvider} object
@@ -197,12 +468,15 @@ class HolidayProvider(object):
         """
         self.annual = dict() # key = (d,m)
         self.monthly = dict() # key = d
-        self.fixed = dict() # key = date()
+        self.fixed = dict() # key = year, then date()
+        self.ranges = dict() # key = year
+        self.nrules = 0
         self.orth_easter = dict() # key = daysdelta
         self.george = [] # key = n/a
         self.cath_easter = dict() # key = daysdelta
         self.cache = dict() # key = date()
         self.ycache = set() # key = year
+        self.mcache = dict() # key = (year,month)
         self.s_normal = s_normal
         self.s_weekend = s_weekend
         self.s_holiday = s_holiday
@@ -211,54 +485,6 @@ class HolidayProvider(object):
         self.s_weekend_multi = s_weekend_multi
         self.multiday_markers = multiday_markers
 
-    def _parse_day_record(self, fields):
-        """return tuple (etype,ddef,footer,header,flags)
-
-           @rtype: (char,type(ddef),str,str,int)
-           @note: I{ddef} is one of the following:
-                - None
-                - int
-                - ((y,m,d),)
-                - ((y,m,d),(y,m,d))
-        """
-        if len(fields) != 5:
-            raise ValueError("Too many fields: " + str(fields))
-        for i in range(len(fields)):
-            if len(fields[i]) == 0: fields[i] = None
-        if fields[0] == 'd':
-            if fields[1]:
-                if '*' in fields[1]:
-                    if fields[0] != 'd':
-                        raise ValueError("multi-day events not allowed with event type '%s'" % fields[0])
-                    dstr,spanstr = fields[1].split('*')
-                    if len(dstr) != 8:
-                        raise ValueError("multi-day events allowed only with full date, not '%s'" % dstr)
-                    span = int(spanstr)
-                    y,m,d = _decode_date_str(dstr)
-                    dt1 = date(y,m,d)
-                    dt2 = dt1 + timedelta(span-1)
-                    res = ((y,m,d),(dt2.year,dt2.month,dt2.day))
-                elif '-' in fields[1]:
-                    if fields[0] != 'd':
-                        raise ValueError("multi-day events not allowed with event type '%s'" % fields[0])
-                    dstr,dstr2 = fields[1].split('-')
-                    if len(dstr) != 8:
-                        raise ValueError("multi-day events allowed only with full date, not '%s'" % dstr)
-                    y,m,d = _decode_date_str(dstr)
-                    y2,m2,d2 = _decode_date_str(dstr2)
-                    res = ((y,m,d),(y2,m2,d2))
-                else:
-                    y,m,d = _decode_date_str(fields[1])
-                    if len(fields[1]) == 8:
-                        res = ((y,m,d),(y,m,d))
-                    else:
-                        res = ((y,m,d),)
-            else:
-                res = None
-        else:
-            res = int(fields[1])
-        return (fields[0],res,fields[2],fields[3],fields[4])
-
     def _multi_holiday_tuple(self, header, footer, flags):
         """returns a 4-tuple of L{Holiday} objects representing (beginning, end, first-day-of-month, rest)
 
@@ -315,54 +541,94 @@ class HolidayProvider(object):
             ce|1||Easter Monday|off
             d|20130223-20130310|winter vacations (B)||multi
 
+        If an up-to-date compiled form of the file exists (see L{compile_holiday_file}), it
+        is loaded instead, skipping text parsing altogether.
+
         @param filename: file to be loaded
         """
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line: continue
-                if line[0] == '#': continue
-                fields = line.split('|')
-                etype,ddef,footer,header,flags = self._parse_day_record(fields)
-                hol = Holiday([header], [footer], flags)
-                if etype == 'd':
-                    if len(ddef) == 1:
-                        y,m,d = ddef[0]
-                        if m > 0:           # annual event
-                            if (d,m) not in self.annual: self.annual[(d,m)] = []
-                            self.annual[(d,m)].append(hol)
-                        else:               # monthly event
-                            if d not in self.monthly: self.monthly[d] = []
-                            self.monthly[d].append(hol)
-                    else:                   # fixed date event
-                        dt1,dt2 = date(*ddef[0]),date(*ddef[1])
-                        span = (dt2-dt1).days + 1
-                        if span == 1:
-                            if dt1 not in self.fixed: self.fixed[dt1] = []
-                            self.fixed[dt1].append(hol)
-                        else:
-                            # properly annotate multi-day events
-                            hols = self._multi_holiday_tuple(header, footer, flags)
-                            dt = dt1
-                            while dt <= dt2:
-                                if dt not in self.fixed: self.fixed[dt] = []
-                                if dt == dt1: hol = hols[0]
-                                elif dt == dt2: hol = hols[1]
-                                elif dt.day == 1: hol = hols[2]
-                                else: hol = hols[3]
-                                self.fixed[dt].append(hol)
-                                dt += timedelta(1)
-
-                elif etype == 'oe':
-                    d = ddef
-                    if d not in self.orth_easter: self.orth_easter[d] = []
-                    self.orth_easter[d].append(hol)
-                elif etype == 'ge':
-                    self.george.append(hol)
-                elif etype == 'ce':
-                    d = ddef
-                    if d not in self.cath_easter: self.cath_easter[d] = []
-                    self.cath_easter[d].append(hol)
+        records = _read_compiled_records(filename, compiled_name(filename))
+        if records is None: records = _read_text_records(filename)
+        for etype,ddef,footer,header,flags in records:
+            hol = Holiday([header], [footer], flags)
+            if etype == 'd':
+                if len(ddef) == 1:
+                    y,m,d = ddef[0]
+                    if m > 0:           # annual event
+                        if (d,m) not in self.annual: self.annual[(d,m)] = []
+                        self.annual[(d,m)].append(hol)
+                    else:               # monthly event
+                        if d not in self.monthly: self.monthly[d] = []
+                        self.monthly[d].append(hol)
+                else:                   # fixed date event
+                    dt1,dt2 = date(*ddef[0]),date(*ddef[1])
+                    self.nrules += 1
+                    if dt1 == dt2:
+                        bucket = self.fixed.setdefault(dt1.year, dict())
+                        if dt1 not in bucket: bucket[dt1] = []
+                        bucket[dt1].append((self.nrules, hol))
+                    else:
+                        # properly annotate multi-day events, deferring expansion until a year is requested
+                        rng = (self.nrules, dt1, dt2, self._multi_holiday_tuple(header, footer, flags))
+                        for y in range(dt1.year, dt2.year + 1):
+                            self.ranges.setdefault(y, []).append(rng)
+
+            elif etype == 'oe':
+                d = ddef
+                if d not in self.orth_easter: self.orth_easter[d] = []
+                self.orth_easter[d].append(hol)
+            elif etype == 'ge':
+                self.george.append(hol)
+            elif etype == 'ce':
+                d = ddef
+                if d not in self.cath_easter: self.cath_easter[d] = []
+                self.cath_easter[d].append(hol)
+
+    def _fill_year(self, y):
+        """precompute all holidays that belong in year I{y} and store them into L{cache}, indexed by C{date()} objects"""
+        # annual
+        for d0,m0 in self.annual:
+            dt = date(y,m0,d0)
+            if not dt in self.cache: self.cache[dt] = Holiday()
+            self.cache[dt].merge_with(self.annual[(d0,m0)])
+        # monthly
+        for d0 in self.monthly:
+          for m0 in range(1,13):
+            if d0 > monthrange(y,m0)[1]: continue
+            dt = date(y,m0,d0)
+            if not dt in self.cache: self.cache[dt] = Holiday()
+            self.cache[dt].merge_with(self.monthly[d0])
+        # fixed, and multi-day ranges clipped to year y, merged in file order
+        fixed = dict((dt, list(hols)) for dt,hols in self.fixed.get(y, {}).items())
+        for seq,dt1,dt2,hols in self.ranges.get(y, ()):
+            dt = max(dt1, date(y,1,1))
+            dt_end = min(dt2, date(y,12,31))
+            while dt <= dt_end:
+                if dt == dt1: hol = hols[0]
+                elif dt == dt2: hol = hols[1]
+                elif dt.day == 1: hol = hols[2]
+                else: hol = hols[3]
+                fixed.setdefault(dt, []).append((seq, hol))
+                dt += timedelta(1)
+        for dt,hols in fixed.items():
+            if not dt in self.cache: self.cache[dt] = Holiday()
+            self.cache[dt].merge_with([hol for seq,hol in sorted(hols, key=lambda x: x[0])])
+        # orthodox easter
+        edt, cedt, gdt = get_easter_table()(y)
+        for delta in self.orth_easter:
+            dt = edt + timedelta(delta)
+            if not dt in self.cache: self.cache[dt] = Holiday()
+            self.cache[dt].merge_with(self.orth_easter[delta])
+        # Georgios day
+        if self.george:
+            if not gdt in self.cache: self.cache[gdt] = Holiday()
+            self.cache[gdt].merge_with(self.george)
+        # catholic easter
+        for delta in self.cath_easter:
+            dt = cedt + timedelta(delta)
+            if not dt in self.cache: self.cache[dt] = Holiday()
+            self.cache[dt].merge_with(self.cath_easter[delta])
+
+        self.ycache.add(y)
 
     def get_holiday(self, y, m, d):
         """return a L{Holiday} object for the specified date (y,m,d) or C{None} if no holiday is defined
@@ -371,47 +637,42 @@ class HolidayProvider(object):
         @note: If year I{y} has not been requested before, the cache is updated first
         with all holidays that belong in I{y}, indexed by C{date()} objects.
         """
-        if y not in self.ycache:
-            # fill-in events for year y
-            # annual
-            for d0,m0 in self.annual:
-                dt = date(y,m0,d0)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.annual[(d0,m0)])
-            # monthly
-            for d0 in self.monthly:
-              for m0 in range(1,13):
-                dt = date(y,m0,d0)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.monthly[m0])
-            # fixed
-            for dt in [z for z in self.fixed if z.year == y]:
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.fixed[dt])
-            # orthodox easter
-            edt = _get_orthodox_easter(y)
-            for delta in self.orth_easter:
-                dt = edt + timedelta(delta)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.orth_easter[delta])
-            # Georgios day
-            if self.george:
-                dt = date(y,4,23)
-                if edt >= dt: dt = edt + timedelta(1)  # >= or > ??
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.george)
-            # catholic easter
-            edt = _get_catholic_easter(y)
-            for delta in self.cath_easter:
-                dt = edt + timedelta(delta)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.cath_easter[delta])
-
-            self.ycache.add(y)
-
+        if y not in self.ycache: self._fill_year(y)
         dt = date(y,m,d)
         return self.cache[dt] if dt in self.cache else None
 
+    def month_table(self, year, month):
+        """return the (header,footer,day_style) tuples of every day in I{month}, computed in one pass
+
+        Item I{k} of the returned list corresponds to day of month M{k+1}, so that
+        C{month_table(year,month)[dom-1]} equals C{self(year,month,dom,dow)}. Tables are
+        computed once and kept in L{mcache}, so layouts may query them for every month they draw.
+
+        @rtype: [(str,str,Style),...]
+        """
+        key = (year,month)
+        if key not in self.mcache:
+            if year not in self.ycache: self._fill_year(year)
+            dow, span = monthrange(year, month)
+            table = []
+            for dom in range(1,span+1):
+                hol = self.cache.get(date(year,month,dom))
+                if hol:
+                    table.append((hol.header(),hol.footer(),self.get_style(hol.flags,dow)))
+                else:
+                    table.append((None,None,self.get_style(0,dow)))
+                dow = (dow + 1) % 7
+            self.mcache[key] = table
+        return self.mcache[key]
+
+    def year_table(self, year):
+        """return the month tables of all months in I{year}, see L{month_table}
+
+        @rtype: [[(str,str,Style),...],...]
+        @return: 12-element list, item I{k} holds the table of month M{k+1}
+        """
+        return [self.month_table(year,m) for m in range(1,13)]
+
     def get_style(self, flags, dow):
         """return appropriate style object, depending on I{flags} and I{dow}
 
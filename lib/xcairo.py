@@ -23,8 +23,11 @@
 # ********************************************************************
 
 import cairo
+import io
 import math
 import random
+import threading
+from collections import OrderedDict
 from os.path import splitext
 from .geom import *
 
@@ -133,25 +136,30 @@ class PageWriter(Page):
     L{keep_transparency}
     @ivar Surface: cairo surface (set by L{_setup_surface_and_context})
     @ivar cr: cairo context (set by L{_setup_surface_and_context})
+    @ivar sink: if not C{None}, list receiving PNG pages as C{bytes}, instead of writing files
     """
 
     PDF = 0
     PNG = 1
-    def __init__(self, filename, pagespec = None, keep_transparency = True, landscape = False, b = 0.0):
+    def __init__(self, filename, pagespec = None, keep_transparency = True, landscape = False, b = 0.0, sink = None):
         """initialize PageWriter object
 
         see also L{Page.__init__}
         @param filename: output filename (extension determines format PDF or PNG)
         @param pagespec: iso page spec, see L{page_spec}
         @param keep_transparency: see L{keep_transparency}
+        @param sink: see L{sink}; PNG output only
         """
         self.base,self.ext = splitext(filename)
         self.filename = filename
         self.curpage = 1
+        self.sink = sink
         if self.ext.lower() == ".pdf": self.format = PageWriter.PDF
         elif self.ext.lower() == ".png": self.format = PageWriter.PNG
         else:
             raise InvalidFormat(self.ext)
+        if sink is not None and self.format != PageWriter.PNG:
+            raise InvalidFormat(self.ext)
         self.keep_transparency = keep_transparency
         if keep_transparency:
             self.img_format = cairo.FORMAT_ARGB32
@@ -186,8 +194,12 @@ class PageWriter(Page):
             self.cr.fill()
         
     def end_page(self):
-        """in PNG mode, output a separate file for each page"""
-        if self.format == PageWriter.PNG:
+        """in PNG mode, output a separate file for each page (or append it to L{sink})"""
+        if self.format == PageWriter.PNG and self.sink is not None:
+            buf = io.BytesIO()
+            self.Surface.write_to_png(buf)
+            self.sink.append(buf.getvalue())
+        elif self.format == PageWriter.PNG:
             outfile = self.filename if self.curpage < 2 else self.base + "%02d" % (self.curpage) + self.ext 
             self.Surface.write_to_png(outfile)
             
@@ -200,6 +212,56 @@ class PageWriter(Page):
             self._setup_surface_and_context()
 
             
+class TileCache(object):
+    """render-once cache of drawings, recorded on C{cairo.RecordingSurface} objects and replayed on demand
+
+    Tiles are recorded in device space, so that device-dependent effects (such as shadows)
+    come out right. A tile is therefore replayed only on a context whose transformation matrix
+    differs from the one used for recording by a translation; the linear part of the matrix
+    becomes part of the cache key.
+
+    @ivar tiles: recorded tiles as C{(surface,x0,y0)} tuples, in LRU order, where I{x0,y0} is
+    the device-space translation at recording time
+    @ivar max_size: maximum number of tiles kept
+    """
+    def __init__(self, max_size = 64):
+        self.tiles = OrderedDict()
+        self.max_size = max_size
+
+    def draw(self, cr, key, rect, draw_fn):
+        """draw a tile on I{cr}, recording it with C{draw_fn(cr)} the first time I{key} is seen
+
+        @param cr: cairo context
+        @param key: hashable tile signature; drawing must depend only on I{key} and the current transformation
+        @param rect: tile rectangle (x,y,w,h) in user space, used for bounding the recording
+        @param draw_fn: function drawing the tile on the cairo context given as argument
+        """
+        m = cr.get_matrix()
+        x0, y0 = m.x0, m.y0
+        key = (key, m.xx, m.yx, m.xy, m.yy)
+        tile = self.tiles.get(key)
+        if tile is None:
+            x1, y1, x2, y2 = rect_to_abs(rect)
+            corners = [cr.user_to_device(x, y) for x, y in ((x1,y1),(x1,y2),(x2,y1),(x2,y2))]
+            u1, v1 = min(c[0] for c in corners), min(c[1] for c in corners)
+            u2, v2 = max(c[0] for c in corners), max(c[1] for c in corners)
+            margin = 0.1*max(u2 - u1, v2 - v1)
+            surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                            cairo.Rectangle(u1 - margin, v1 - margin, u2 - u1 + 2*margin, v2 - v1 + 2*margin))
+            rcr = cairo.Context(surface)
+            rcr.set_matrix(m)
+            draw_fn(rcr)
+            tile = self.tiles[key] = (surface, x0, y0)
+            if len(self.tiles) > self.max_size: self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        surface, rx0, ry0 = tile
+        cr.save()
+        cr.identity_matrix()
+        cr.set_source_surface(surface, x0 - rx0, y0 - ry0)
+        cr.paint()
+        cr.restore()
+
 def set_color(cr, rgba):
     """set stroke color
 
@@ -219,6 +281,77 @@ def extract_font_name(f):
     """
     return f if type(f) is str else f[0]
 
+def _font_key(font):
+    """return a I{(fontname,slant,weight)} tuple from a string or from a (fontname[,slant[,weight]]) tuple
+
+    @rtype: (str,int,int)
+    """
+    slant = weight = 0
+    if type(font) is str: fontname = font
+    elif len(font) == 3: fontname, slant, weight = font
+    elif len(font) == 2: fontname, slant = font
+    elif len(font) == 1: fontname = font[0]
+    return (fontname, slant, weight)
+
+_font_faces = dict()
+"""C{cairo.ToyFontFace} objects, indexed by I{(fontname,slant,weight)}"""
+_scaled_fonts = dict()
+"""C{cairo.ScaledFont} objects used for measuring text, indexed by I{(fontname,slant,weight)}"""
+_extents = OrderedDict()
+"""LRU cache of text extents, indexed by I{(fontname,slant,weight,text)}"""
+_extents_mutex = threading.Lock()
+"""mutex for L{_extents} access"""
+
+EXTENTS_CACHE_SIZE = 4096
+"""maximum number of entries kept by L{text_extents}"""
+
+def get_font_face(font):
+    """return a cached C{cairo.ToyFontFace} for I{font}
+
+    @param font: font name as string or (font,slant,weight) tuple
+    @rtype: cairo.ToyFontFace
+    """
+    key = _font_key(font)
+    face = _font_faces.get(key)
+    if face is None:
+        face = _font_faces[key] = cairo.ToyFontFace(*key)
+    return face
+
+def _get_scaled_font(key):
+    """return a cached C{cairo.ScaledFont} at cairo's default size (10) and identity transform, without hinting
+
+    @rtype: cairo.ScaledFont
+    """
+    sf = _scaled_fonts.get(key)
+    if sf is None:
+        fo = cairo.FontOptions()
+        fo.set_hint_style(cairo.HINT_STYLE_NONE)
+        fo.set_hint_metrics(cairo.HINT_METRICS_OFF)
+        sf = _scaled_fonts[key] = cairo.ScaledFont(get_font_face(key), cairo.Matrix(xx=10.0, yy=10.0),
+                                                   cairo.Matrix(), fo)
+    return sf
+
+def text_extents(font, text):
+    """return the extents of I{text} rendered in I{font}, as C{cairo.Context.text_extents()} would at the default font size
+
+    Results are kept in a bounded LRU cache, since the same strings (day numbers,
+    measurement strings etc.) are measured over and over while drawing a calendar.
+
+    @param font: font name as string or (font,slant,weight) tuple
+    @rtype: cairo.TextExtents
+    """
+    key = _font_key(font) + (text,)
+    with _extents_mutex:
+        te = _extents.get(key)
+        if te is not None:
+            _extents.move_to_end(key)
+            return te
+    te = _get_scaled_font(key[0:3]).text_extents(text)
+    with _extents_mutex:
+        _extents[key] = te
+        if len(_extents) > EXTENTS_CACHE_SIZE: _extents.popitem(last=False)
+    return te
+
 def make_sloppy_rect(cr, rect, sdx = 0.0, sdy = 0.0, srot = 0.0):
     """slightly rotate and translate a rect to give it a sloppy look
 
@@ -345,14 +478,9 @@ def draw_str(cr, text, rect, scaling = -1, stroke_rgba = None, align = (2,0), bb
     """
     x, y, w, h = rect
     cr.save()
-    slant = weight = 0
-    if type(font) is str: fontname = font
-    elif len(font) == 3: fontname, slant, weight = font
-    elif len(font) == 2: fontname, slant = font
-    elif len(font) == 1: fontname = font[0]
-    cr.select_font_face(fontname, slant, weight)
+    cr.set_font_face(get_font_face(font))
     if measure is None: measure = text
-    te = cr.text_extents(measure)
+    te = text_extents(font, measure)
     mw, mh = te[2], te[3]
     if mw < 5:
       mw = 5.
@@ -365,7 +493,7 @@ def draw_str(cr, text, rect, scaling = -1, stroke_rgba = None, align = (2,0), bb
     elif scaling == 1: crs = (1.0/xratio, 1.0/xratio)
     elif scaling == 2: crs = (1.0/yratio, 1.0/yratio)
     elif scaling == 3: crs = (1.0/xratio, 1.0/yratio)
-    te = cr.text_extents(text)
+    te = text_extents(font, text)
     tw,th = te[2], te[3]
     tw *= crs[0]
     th *= crs[1]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2015 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+"""calmagick regression tests"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import calmagick
+
+class IterFilesTest(unittest.TestCase):
+    """L{calmagick.iter_files} must match C{sorted(glob.glob(pattern, recursive=True))}"""
+    files = ['top.jpg', 'a/1.jpg', 'a/B.jpg', 'a/b/2.jpg', 'a/b/c/3.jpg', 'a.b/3.jpg', 'a.b/x/4.jpg',
+             'ab/0.jpg', 'x/1.jpg', 'x/x/2.jpg', 'x/x/x/3.jpg', '.h/d/8.jpg', 'a/.hid/9.jpg']
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        for f in self.files:
+            os.makedirs(os.path.join(self.tmp, os.path.dirname(f)), exist_ok=True)
+            open(os.path.join(self.tmp, f), 'w').close()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_glob_order(self):
+        for p in ['*/*.jpg', '**/*.jpg', '**', 'a/**/*.jpg', '**/x/*.jpg', '*/**/*.jpg', 'a*/**/*.jpg',
+                  'x/**/x/*.jpg', os.path.join(self.tmp, '**', '*.jpg')]:
+            expected = [f for f in sorted(glob.glob(p, recursive=True)) if os.path.isfile(f)]
+            self.assertEqual(list(calmagick.iter_files(p)), expected, p)
+
+    def test_nested(self):
+        found = list(calmagick.iter_files('**/*.jpg'))
+        self.assertIn(os.path.join('a', 'b', '2.jpg'), found)
+        self.assertIn(os.path.join('a', 'b', 'c', '3.jpg'), found)
+        self.assertNotIn(os.path.join('.h', 'd', '8.jpg'), found)
+
+class FitRectTest(unittest.TestCase):
+    """L{calmagick.PNMImage.fit_rect} must fit the dimension selected by the ratio of ratios"""
+
+    @staticmethod
+    def flat(w, h):
+        return calmagick.PNMImage([b'P2', b'%d %d' % (w,h), b'255'] + [b' '.join([b'0']*w)]*h)
+
+    def test_square(self):
+        avg, frac, pos, sz, best = self.flat(60, 60).fit_rect((0.333, 0.8), 7, 0.2, 1.0)
+        self.assertEqual(sz, (48, 48))
+        avg, frac, pos, sz, best = self.flat(60, 60).fit_rect((0.333, 0.8), 7, 0.2, 1.5)
+        self.assertEqual(sz, (48, 32))
+
+    def test_non_square(self):
+        # 16:9 map, 3:2 calendar (16/9*0.844 = 1.5): the rectangle fits y first
+        pnm = self.flat(80, 45)
+        avg, frac, pos, sz, best = pnm.fit_rect((0.333, 0.8), 7, 0.2, 0.844)
+        self.assertLessEqual(frac[1], 0.8)
+        self.assertEqual(sz, (54, 36))
+        avg, frac, pos, sz, best = pnm.fit_rect((0.333, 1.0), 7, 0.2, 0.844)
+        self.assertEqual(sz, (68, 45))
+        # a wider calendar on the same map (ratio 2.13) fits x first
+        avg, frac, pos, sz, best = pnm.fit_rect((0.333, 0.8), 7, 0.2, 1.2)
+        self.assertEqual(frac[0], 0.8)
+        self.assertEqual(sz, (64, 30))
+
+if __name__ == '__main__':
+    unittest.main()